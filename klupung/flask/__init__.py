@@ -14,20 +14,64 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import functools
+
 import flask
 import flask.ext.sqlalchemy
 import flask.ext.autodoc
+import sqlalchemy.event
 
 db = flask.ext.sqlalchemy.SQLAlchemy()
 
-def create_app(db_uri):
+# Pragmas executed on every new SQLite connection, can be overridden
+# with KLUPUNG_SQLITE_PRAGMAS config value. WAL lets readers proceed
+# while the database is being written, and with WAL, synchronous=NORMAL
+# fsyncs only at checkpoints instead of every commit.
+DEFAULT_SQLITE_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("mmap_size", 256 * 1024 * 1024),
+    ("cache_size", -16 * 1024), # Negative value is in KiB.
+    ("temp_store", "MEMORY"),
+    )
+
+def _set_sqlite_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas:
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+    finally:
+        cursor.close()
+
+def create_app(db_uri, config=None):
     app = flask.Flask(__name__)
     app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
+    app.config['KLUPUNG_SQLITE_PRAGMAS'] = DEFAULT_SQLITE_PRAGMAS
+    # Seconds total counts of result lists are cached, 0 disables.
+    app.config['KLUPUNG_COUNT_CACHE_TIMEOUT'] = 60
+    # See klupung.flask.cache. Responses are invalidated by the data
+    # version, the timeout only limits how long stale responses take
+    # space in shared caches.
+    app.config['KLUPUNG_RESPONSE_CACHE_THRESHOLD'] = 500
+    app.config['KLUPUNG_RESPONSE_CACHE_MAX_SIZE'] = 64 * 1024 * 1024
+    app.config['KLUPUNG_RESPONSE_CACHE_TIMEOUT'] = 24 * 60 * 60
+    app.config['KLUPUNG_SHARED_RESPONSE_CACHE'] = None
+    if config is not None:
+        app.config.update(config)
 
     db.init_app(app)
 
+    engine = db.get_engine(app)
+    if engine.dialect.name == "sqlite":
+        sqlalchemy.event.listen(engine, "connect",
+                                functools.partial(_set_sqlite_pragmas,
+                                                  app.config['KLUPUNG_SQLITE_PRAGMAS']))
+
+    import klupung.flask.cache
+    klupung.flask.cache.init_app(app)
+
     import klupung.flask.api
-    klupung.flask.api.auto.init_app(app)
+    klupung.flask.api.init_app(app)
 
     app.register_blueprint(klupung.flask.api.v0)
 
@@ -15,16 +15,31 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 ## Standard library imports
+import base64
 import datetime
+import json
 import re
 import urllib
 
 ## 3rd party imports
 import flask
 import flask.ext.autodoc
+import sqlalchemy.orm
+import werkzeug.contrib.cache
+
+# simplejson is used if it is available. Otherwise, the standard
+# library encoder is as fast when the output is compact and keys are
+# not sorted.
+try:
+    import simplejson as _fast_json
+except ImportError:
+    _fast_json = json
 
 ## Local imports
+import klupung.flask.cache
 import klupung.flask.models
+import klupung.flask.search
+import klupung.flask.spatial
 
 class Error(Exception):
     """Common base class for all API-related exceptions."""
@@ -48,8 +63,25 @@ class UnknownArgumentError(Error):
         message = "Unknown argument '%s'." % name
         Error.__init__(self, 400, message)
 
-_STRFMT_DATETIME = "%Y-%m-%dT%H:%M:%S.%f"
-_STRFMT_DATE = "%Y-%m-%d"
+# Equivalent to strftime formats "%Y-%m-%dT%H:%M:%S.%f" and
+# "%Y-%m-%d", but faster.
+_STRFMT_DATETIME = "%04d-%02d-%02dT%02d:%02d:%02d.%06d"
+_STRFMT_DATE = "%04d-%02d-%02d"
+
+# Resources of a list share many datetimes, e.g. meeting dates.
+_DATETIME_STRING_CACHE_SIZE = 10000
+_datetime_strings = {}
+
+# Any integer which does not otherwise appear in URLs.
+_URL_TEMPLATE_PLACEHOLDER = 9876543210123
+_url_templates = {}
+
+# Arguments which select a page of a result list but do not affect
+# the number of objects in the list.
+_PAGINATION_ARGS = frozenset(["limit", "offset", "page", "after", "total_count"])
+
+_COUNT_CACHE_EXTENSION_NAME = "klupung.flask.api.count_cache"
+_COUNT_CACHE_THRESHOLD = 1000
 
 def _get_uint_arg(name, default):
     """Return `int` value of argument `name` from the current request
@@ -87,6 +119,26 @@ def _get_choice_arg(name, choices):
                                    expected=" or ".join([repr(s) for s in choices]))
     return arg
 
+def _get_bbox_arg(name):
+    """Return (min_x, min_y, max_x, max_y) tuple of `float` values of
+    argument `name` from the current request
+
+    Raises `InvalidArgumentError` if the value is not four
+    comma-separated numbers.
+
+    """
+
+    arg = flask.request.args[name]
+    try:
+        bbox = tuple(float(v) for v in arg.split(","))
+    except ValueError:
+        raise InvalidArgumentError(arg, name,
+                                   expected="four comma-separated numbers")
+    if len(bbox) != 4:
+        raise InvalidArgumentError(arg, name,
+                                   expected="four comma-separated numbers")
+    return bbox
+
 def _get_order_by_arg(sortable_fields):
     choices = []
     for field in sortable_fields:
@@ -98,7 +150,49 @@ def _get_order_by_arg(sortable_fields):
 
     return column_name, is_descending
 
-def _jsonified_query_results(query, get_resource):
+def _format_datetime(value):
+    try:
+        return _datetime_strings[value]
+    except KeyError:
+        if len(_datetime_strings) >= _DATETIME_STRING_CACHE_SIZE:
+            _datetime_strings.clear()
+        string = _STRFMT_DATETIME % (value.year, value.month, value.day,
+                                     value.hour, value.minute, value.second,
+                                     value.microsecond)
+        _datetime_strings[value] = string
+        return string
+
+def _format_date(value):
+    return _STRFMT_DATE % (value.year, value.month, value.day)
+
+def _url_for_id(endpoint, name, value):
+    """Return the same URL as flask.url_for(endpoint, **{name: value})
+    for an integer id `value`
+
+    The URL is formatted from a template which is built once per
+    endpoint and script root by calling flask.url_for().
+
+    """
+
+    key = (flask.request.script_root, endpoint)
+    try:
+        template = _url_templates[key]
+    except KeyError:
+        url = flask.url_for(endpoint, **{name: _URL_TEMPLATE_PLACEHOLDER})
+        template = url.replace("%", "%%").replace(str(_URL_TEMPLATE_PLACEHOLDER), "%d")
+        _url_templates[key] = template
+    return template % value
+
+def _jsonify(obj):
+    """Return a response with compact JSON representation of `obj`."""
+
+    return flask.current_app.response_class(
+        _fast_json.dumps(obj, separators=(",", ":")),
+        mimetype="application/json")
+
+def _jsonified_query_results(query, get_resource, eager_options=()):
+    query = query.options(*eager_options)
+
     meta = {
         "criterion": flask.request.query_string,
         }
@@ -108,11 +202,13 @@ def _jsonified_query_results(query, get_resource):
         "objects": [get_resource(model) for model in query.all()],
         }
 
-    return flask.jsonify(**resource)
+    return _jsonify(resource)
 
-def _jsonified_resource(model_class, get_resource, primary_key):
-    resource = get_resource(model_class.query.get_or_404(primary_key))
-    return flask.jsonify(**resource)
+def _jsonified_resource(model_class, get_resource, primary_key,
+                        eager_options=()):
+    query = model_class.query.options(*eager_options)
+    resource = get_resource(query.get_or_404(primary_key))
+    return _jsonify(resource)
 
 def _encode_args(in_dict):
     out_dict = {}
@@ -124,9 +220,155 @@ def _encode_args(in_dict):
         out_dict[k] = v
     return out_dict
 
+def _get_total_count(query):
+    """Return the number of rows `query` returns for the current request
+
+    Counts are cached for KLUPUNG_COUNT_CACHE_TIMEOUT seconds by the
+    path and the filter arguments of the request. Each application has
+    its own cache, because applications may have different databases.
+    Cached counts are not used after the data version has changed.
+
+    """
+
+    timeout = flask.current_app.config["KLUPUNG_COUNT_CACHE_TIMEOUT"]
+    if not timeout:
+        return query.count()
+
+    version, _ = klupung.flask.cache.get_data_version()
+    filter_args = sorted((k, v) for k, v in flask.request.args.iteritems(multi=True)
+                         if k not in _PAGINATION_ARGS)
+    key = repr((version, flask.request.path, filter_args))
+
+    count_cache = flask.current_app.extensions[_COUNT_CACHE_EXTENSION_NAME]
+    total_count = count_cache.get(key)
+    if total_count is None:
+        total_count = query.count()
+        count_cache.set(key, total_count, timeout=timeout)
+    return total_count
+
+def _encode_cursor(order_by, sort_value, primary_key):
+    return base64.urlsafe_b64encode(json.dumps([order_by, sort_value, primary_key]))
+
+def _decode_cursor(arg, name, order_by):
+    """Return (sort_value, primary_key) tuple decoded from cursor `arg`
+
+    Raises `InvalidArgumentError` if the cursor is malformed or it has
+    been created for another ordering.
+
+    """
+
+    error = InvalidArgumentError(arg, name,
+                                 expected="a cursor returned in meta.next_cursor")
+    try:
+        cursor_order_by, sort_value, primary_key = json.loads(
+            base64.urlsafe_b64decode(arg.encode("ascii")))
+    except (TypeError, ValueError):
+        raise error
+    if cursor_order_by != order_by or not isinstance(primary_key, int):
+        raise error
+    return sort_value, primary_key
+
+def _filter_after(query, sort_column, is_descending, primary_key_column,
+                  sort_value, primary_key):
+    """Return the query filtered to rows following (sort_value,
+    primary_key) when ordered by sort_column and primary_key_column to
+    the same direction. NULLs are first in ascending order and last in
+    descending order, like in SQLite.
+
+    """
+
+    if is_descending:
+        after_primary_key = primary_key_column < primary_key
+    else:
+        after_primary_key = primary_key_column > primary_key
+
+    if sort_column is None:
+        return query.filter(after_primary_key)
+
+    if sort_value is None:
+        criterion = (sort_column == None) & after_primary_key
+        if not is_descending:
+            criterion = criterion | (sort_column != None)
+    else:
+        if is_descending:
+            after_sort_value = sort_column < sort_value
+        else:
+            after_sort_value = sort_column > sort_value
+        criterion = after_sort_value | ((sort_column == sort_value) & after_primary_key)
+        if is_descending:
+            criterion = criterion | (sort_column == None)
+
+    return query.filter(criterion)
+
+def _jsonified_resource_list_after(model_class, get_resource, query, limit,
+                                   order_by, sort_column, is_descending):
+    """Return a page of resources following the row of the cursor given
+    in argument `after`, or the first page if the argument is empty.
+
+    Unlike offset pagination, cursor pagination does not count rows or
+    walk the rows of the preceding pages.
+
+    """
+
+    primary_key_column = model_class.id
+
+    # SQLite stores datetimes as strings, which are not necessarily in
+    # the format SQLAlchemy binds datetimes with. Hence cursors carry
+    # datetimes as stored and they are compared as such.
+    if sort_column is not None and isinstance(sort_column.type, sqlalchemy.DateTime):
+        sort_column = sqlalchemy.type_coerce(sort_column, sqlalchemy.String)
+
+    cursor = flask.request.args["after"]
+    if cursor:
+        sort_value, primary_key = _decode_cursor(cursor, "after", order_by)
+        query = _filter_after(query, sort_column, is_descending,
+                              primary_key_column, sort_value, primary_key)
+
+    if sort_column is not None:
+        query = query.add_columns(sort_column)
+        query = query.order_by(sort_column.desc() if is_descending else sort_column)
+    query = query.order_by(primary_key_column.desc() if is_descending
+                           else primary_key_column)
+
+    # One extra row tells whether there is a next page.
+    rows = query.limit(limit + 1).all()
+
+    next_cursor = None
+    next_path = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_row = rows[-1]
+        if sort_column is None:
+            last_model, last_sort_value = last_row, None
+        else:
+            last_model, last_sort_value = last_row
+        next_cursor = _encode_cursor(order_by, last_sort_value, last_model.id)
+        next_path_args = _encode_args(flask.request.args.to_dict())
+        next_path_args["after"] = next_cursor
+        next_path = "%s?%s" % (flask.request.path, urllib.urlencode(next_path_args))
+
+    if sort_column is not None:
+        models = [model for model, _ in rows]
+    else:
+        models = rows
+
+    meta = {
+        "limit"       : limit,
+        "next"        : next_path,
+        "next_cursor" : next_cursor,
+        }
+
+    resource = {
+        "meta"   : meta,
+        "objects": [get_resource(model) for model in models],
+        }
+
+    return _jsonify(resource)
+
 def _jsonified_resource_list(model_class, get_resource,
                              sortable_fields=(), do_paginate=False,
-                             query=None):
+                             query=None, eager_options=(),
+                             sort_columns={}):
     limit = min(_get_uint_arg("limit", 20), 1000)
     offset = _get_uint_arg("offset", 0)
 
@@ -134,38 +376,60 @@ def _jsonified_resource_list(model_class, get_resource,
         page = max(_get_uint_arg("page", 1), 1)
         offset = limit * (page - 1)
 
-    total_count = 0
-    objects = []
-
     if query is None:
         query = model_class.query
 
-    total_count = query.count()
+    order_by = None
+    column = None
+    is_descending = False
 
     if sortable_fields:
         column_name, is_descending = _get_order_by_arg(sortable_fields)
+        order_by = "-%s" % column_name if is_descending else column_name
 
         relationship_name, _, related_column_name = column_name.partition("__")
-        if related_column_name != '':
+        if column_name in sort_columns:
+            column = sort_columns[column_name]
+        elif related_column_name != '':
             relationship = getattr(model_class, relationship_name)
             query = query.join(relationship)
             column = relationship.property.table.columns[related_column_name]
         else:
             column = getattr(model_class, column_name)
 
-        if is_descending:
-            column = column.desc()
+    if "after" in flask.request.args:
+        return _jsonified_resource_list_after(model_class, get_resource,
+                                              query.options(*eager_options),
+                                              limit, order_by, column,
+                                              is_descending)
+
+    if _get_choice_arg("total_count", ("true", "false")) == "true":
+        total_count = _get_total_count(query)
+    else:
+        total_count = None
 
-        query = query.order_by(column)
+    if column is not None:
+        query = query.order_by(column.desc() if is_descending else column)
 
-    query = query.limit(limit).offset(offset)
+    # Without the count, one extra row tells whether there is a next
+    # page.
+    query = query.limit(limit if total_count is not None else limit + 1)
+    query = query.offset(offset)
+    query = query.options(*eager_options)
 
-    objects = [get_resource(model) for model in query.all()]
+    models = query.all()
+    if total_count is None:
+        has_next = len(models) > limit
+        models = models[:limit]
+    else:
+        has_next = limit + offset < total_count
+
+    objects = [get_resource(model) for model in models]
 
     next_path = None
     prev_path = None
 
-    if limit + offset < total_count:
+    if has_next:
         next_path_args = _encode_args(flask.request.args.to_dict())
         next_path_args["offset"] = offset + limit
         next_path = "%s?%s" % (flask.request.path, urllib.urlencode(next_path_args))
@@ -195,18 +459,16 @@ def _jsonified_resource_list(model_class, get_resource,
         "objects": objects,
         }
 
-    return flask.jsonify(**resource)
+    return _jsonify(resource)
 
 def _get_agenda_item_contents(agenda_item):
-    query = klupung.flask.models.Content.query
-    contents = query.filter_by(agenda_item_id=agenda_item.id).order_by(klupung.flask.models.Content.index).all()
-    for content in contents:
+    for content in agenda_item.contents:
         yield {"type": content.content_type, "text": content.text}
 
 def _get_agenda_item_resource(agenda_item):
-    origin_last_modified_time = agenda_item.last_modified_time.strftime(_STRFMT_DATETIME)
+    origin_last_modified_time = _format_datetime(agenda_item.last_modified_time)
     if agenda_item.origin_last_modified_time:
-        origin_last_modified_time = agenda_item.origin_last_modified_time.strftime(_STRFMT_DATETIME)
+        origin_last_modified_time = _format_datetime(agenda_item.origin_last_modified_time)
     return {
         "attachments"                : [],
         "classification_code"        : "",
@@ -217,22 +479,22 @@ def _get_agenda_item_resource(agenda_item):
         "index"                      : agenda_item.index,
         "introducer"                 : agenda_item.introducer,
         "issue"                      : _get_issue_resource(agenda_item.issue) if agenda_item.issue else {},
-        "last_modified_time"         : agenda_item.last_modified_time.strftime(_STRFMT_DATETIME),
+        "last_modified_time"         : _format_datetime(agenda_item.last_modified_time),
         "meeting"                    :  _get_meeting_resource(agenda_item.meeting),
         "origin_last_modified_time"  : origin_last_modified_time,
         "permalink"                  : agenda_item.permalink,
         "preparer"                   : agenda_item.preparer,
         "resolution"                 : agenda_item.resolution,
-        "resource_uri"               : flask.url_for("._agenda_item_id_route",
-                                                     agenda_item_id=agenda_item.id),
+        "resource_uri"               : _url_for_id("._agenda_item_id_route", "agenda_item_id",
+                                                   agenda_item.id),
         "subject"                    : agenda_item.subject,
         }
 
 def _get_category_resource(category):
     parent_uri = None
     if category.parent_id is not None:
-        parent_uri = flask.url_for("._category_id_route",
-                                   category_id=category.parent_id)
+        parent_uri = _url_for_id("._category_id_route", "category_id",
+                                 category.parent_id)
 
     return {
         "id"          : category.id,
@@ -240,8 +502,8 @@ def _get_category_resource(category):
         "name"        : category.name,
         "origin_id"   : category.origin_id,
         "parent"      : parent_uri,
-        "resource_uri": flask.url_for("._category_id_route",
-                                      category_id=category.id),
+        "resource_uri": _url_for_id("._category_id_route", "category_id",
+                                    category.id),
         }
 
 def _get_issue_resource(issue):
@@ -255,23 +517,23 @@ def _get_issue_resource(issue):
                     "coordinates": geometry.coordinates,
                     })
     return {
-        "category"            : flask.url_for("._category_id_route",
-                                              category_id=issue.category_id),
+        "category"            : _url_for_id("._category_id_route", "category_id",
+                                            issue.category_id),
         "category_name"       : issue.category.name,
         "category_origin_id"  : issue.category.origin_id,
         "districts"           : [],
         "geometries"          : geometries,
         "id"                  : issue.id,
-        "last_modified_time"  : issue.last_modified_time.strftime(_STRFMT_DATETIME),
-        "latest_decision_date": issue.latest_decision_date.strftime(_STRFMT_DATETIME),
+        "last_modified_time"  : _format_datetime(issue.last_modified_time),
+        "latest_decision_date": _format_datetime(issue.latest_decision_date),
         "reference_text"      : "",
         "register_id"         : issue.register_id,
         "slug"                : issue.slug,
         "subject"             : issue.subject,
         "summary"             : issue.summary,
         "top_category_name"   : issue.category.find_top_category().name,
-        "resource_uri"        : flask.url_for("._issue_id_route",
-                                              issue_id=issue.id),
+        "resource_uri"        : _url_for_id("._issue_id_route", "issue_id",
+                                            issue.id),
         }
 
 def _get_policymaker_resource(policymaker):
@@ -282,42 +544,73 @@ def _get_policymaker_resource(policymaker):
         "origin_id"   : policymaker.abbreviation,
         "slug"        : policymaker.slug,
         "summary"     : policymaker.summary,
-        "resource_uri": flask.url_for("._policymaker_id_route",
-                                      policymaker_id=policymaker.id),
+        "resource_uri": _url_for_id("._policymaker_id_route", "policymaker_id",
+                                    policymaker.id),
         }
 
 def _get_meeting_resource(meeting):
     return {
         "id"              : meeting.id,
-        "date"            : meeting.date.strftime(_STRFMT_DATE),
+        "date"            : _format_date(meeting.date),
         "minutes"         : True,
         "number"          : meeting.number,
-        "policymaker"     : flask.url_for("._policymaker_id_route",
-                                          policymaker_id=meeting.policymaker.id),
+        "policymaker"     : _url_for_id("._policymaker_id_route", "policymaker_id",
+                                        meeting.policymaker.id),
         "policymaker_name": meeting.policymaker.name,
         "year"            : meeting.date.year,
-        "resource_uri"    : flask.url_for("._meeting_id_route",
-                                          meeting_id=meeting.id),
+        "resource_uri"    : _url_for_id("._meeting_id_route", "meeting_id",
+                                        meeting.id),
         }
 
 def _get_meeting_document_resource(meeting_document):
     return {
         "id"                 : meeting_document.id,
-        "last_modified_time" : meeting_document.publish_datetime.strftime(_STRFMT_DATETIME),
+        "last_modified_time" : _format_datetime(meeting_document.publish_datetime),
         "meeting"            : _get_meeting_resource(meeting_document.meeting),
         "organisation"       : None,
         "origin_id"          : meeting_document.origin_id,
         "origin_url"         : meeting_document.origin_url,
-        "publish_time"       : meeting_document.publish_datetime.strftime(_STRFMT_DATETIME),
+        "publish_time"       : _format_datetime(meeting_document.publish_datetime),
         "type"               : "minutes",
         "xml_uri"            : None,
-        "resource_uri"       : flask.url_for("._meeting_document_id_route",
-                                             meeting_document_id=meeting_document.id)
+        "resource_uri"       : _url_for_id("._meeting_document_id_route", "meeting_document_id",
+                                           meeting_document.id)
     }
 
+# Loader options which prefetch all relationships accessed by the
+# resource functions above, hence serializing a list of models does
+# not lazy load relationships model by model.
+_ISSUE_EAGER_OPTIONS = (
+    sqlalchemy.orm.joinedload_all("category.top_category"),
+    sqlalchemy.orm.subqueryload_all("agenda_items.geometries"),
+    )
+
+_MEETING_EAGER_OPTIONS = (
+    sqlalchemy.orm.joinedload("policymaker"),
+    )
+
+_MEETING_DOCUMENT_EAGER_OPTIONS = (
+    sqlalchemy.orm.joinedload_all("meeting.policymaker"),
+    )
+
+_AGENDA_ITEM_EAGER_OPTIONS = (
+    sqlalchemy.orm.subqueryload("contents"),
+    sqlalchemy.orm.joinedload_all("meeting.policymaker"),
+    sqlalchemy.orm.joinedload_all("issue.category.top_category"),
+    sqlalchemy.orm.subqueryload_all("issue.agenda_items.geometries"),
+    )
+
 auto = flask.ext.autodoc.Autodoc()
 v0 = flask.Blueprint("v0", __name__, url_prefix="/v1")
 
+def init_app(app):
+    auto.init_app(app)
+    app.extensions[_COUNT_CACHE_EXTENSION_NAME] = werkzeug.contrib.cache.SimpleCache(
+        threshold=_COUNT_CACHE_THRESHOLD)
+
+v0.before_request(klupung.flask.cache.get_response)
+v0.after_request(klupung.flask.cache.set_response)
+
 @v0.route("/")
 def _index():
     return auto.html()
@@ -350,7 +643,8 @@ def _agenda_item_filter_route():
         query = query.join(klupung.flask.models.Issue)
         query = query.filter(klupung.flask.models.Issue.id == issue_id)
 
-    return _jsonified_query_results(query, _get_agenda_item_resource)
+    return _jsonified_query_results(query, _get_agenda_item_resource,
+                                    eager_options=_AGENDA_ITEM_EAGER_OPTIONS)
 
 @v0.route("/agenda_item/")
 @auto.doc()
@@ -358,10 +652,13 @@ def _agenda_item_route():
     """Return a list of agenda items of a meeting.
 
     GET parameters:
-        limit    - the maximum number of objects to return
-        offset   - the number of objects to skip from the beginning of the result set
-        order_by - the name of field by which the results are ordered
-        meeting  - the id of the meeting whose agenda items should be returned
+        limit       - the maximum number of objects to return
+        offset      - the number of objects to skip from the beginning of the result set
+        after       - the cursor after which objects are returned, empty for the first
+                      page, replaces offset and page, see meta.next_cursor
+        total_count - false to leave meta.total_count null, which is faster
+        order_by    - the name of field by which the results are ordered
+        meeting     - the id of the meeting whose agenda items should be returned
     """
 
     query = klupung.flask.models.AgendaItem.query
@@ -384,7 +681,8 @@ def _agenda_item_route():
                          "origin_last_modified_time",
                          "meeting__date",
                          "index"],
-        query=query)
+        query=query,
+        eager_options=_AGENDA_ITEM_EAGER_OPTIONS)
 
 @v0.route("/agenda_item/<int:agenda_item_id>/")
 @auto.doc()
@@ -393,7 +691,8 @@ def _agenda_item_id_route(agenda_item_id):
     return _jsonified_resource(
         klupung.flask.models.AgendaItem,
         _get_agenda_item_resource,
-        agenda_item_id)
+        agenda_item_id,
+        eager_options=_AGENDA_ITEM_EAGER_OPTIONS)
 
 @v0.route("/policymaker/")
 @auto.doc()
@@ -401,9 +700,12 @@ def _policymaker_route():
     """Return a list of policymakers.
 
     GET parameters:
-        limit    - the maximum number of objects to return
-        offset   - the number of objects to skip from the beginning of the result set
-        order_by - the name of field by which the results are ordered
+        limit       - the maximum number of objects to return
+        offset      - the number of objects to skip from the beginning of the result set
+        after       - the cursor after which objects are returned, empty for the first
+                      page, replaces offset and page, see meta.next_cursor
+        total_count - false to leave meta.total_count null, which is faster
+        order_by    - the name of field by which the results are ordered
     """
     return _jsonified_resource_list(
         klupung.flask.models.Policymaker,
@@ -427,21 +729,41 @@ def _issue_search_route():
     GET parameters:
         limit       - the maximum number of objects to return
         offset      - the number of objects to skip from the beginning of the result set
-        order_by    - the name of field by which the results are ordered
+        after       - the cursor after which objects are returned, empty for the first
+                      page, replaces offset and page, see meta.next_cursor
+        total_count - false to leave meta.total_count null, which is faster
+        order_by    - the name of field by which the results are ordered,
+                      relevance orders by how well the issues match text
         page        - the number of the page
+        bbox        - filter results by point geometries within a bounding
+                      box given as min_x,min_y,max_x,max_y (west,south,east,north)
         text        - filter results by matching text contents
         policymaker - filter results by matching policymaker id
     """
 
     query = klupung.flask.models.Issue.query
 
+    # Agenda item filters share a single join, joining the same table
+    # twice would be ambiguous.
+    is_agenda_item_joined = False
+
+    # Without text search or the full-text index, all issues are
+    # equally relevant.
+    relevance = sqlalchemy.literal_column("NULL")
+
     try:
-        bbox = flask.request.args["bbox"]
+        min_x, min_y, max_x, max_y = _get_bbox_arg("bbox")
     except KeyError:
         pass
     else:
-        query = query.join(klupung.flask.models.AgendaItem, klupung.flask.models.AgendaItemGeometry)
+        if not is_agenda_item_joined:
+            query = query.join(klupung.flask.models.Issue.agenda_items)
+            is_agenda_item_joined = True
+        query = query.join(klupung.flask.models.AgendaItem.geometries)
         query = query.filter(klupung.flask.models.AgendaItemGeometry.type.like("Point"))
+        query = query.filter(klupung.flask.spatial.intersects_bbox(
+                klupung.flask.models.AgendaItemGeometry.id,
+                min_x, min_y, max_x, max_y))
         query = query.distinct()
 
     try:
@@ -449,12 +771,22 @@ def _issue_search_route():
     except KeyError:
         pass
     else:
-        query = query.join(klupung.flask.models.AgendaItem, klupung.flask.models.Content)
-        query = query.filter(
-            (klupung.flask.models.Content.text.like("%%%s%%" % text))
-            |
-            (klupung.flask.models.AgendaItem.subject.like("%%%s%%" % text)))
-        query = query.distinct()
+        match_query = klupung.flask.search.make_match_query(text)
+        if match_query is not None and klupung.flask.search.has_index():
+            issue_search = klupung.flask.search.search_issues(match_query)
+            query = query.join(issue_search,
+                               klupung.flask.models.Issue.id == issue_search.c.issue_id)
+            relevance = issue_search.c.rank
+        else:
+            if not is_agenda_item_joined:
+                query = query.join(klupung.flask.models.Issue.agenda_items)
+                is_agenda_item_joined = True
+            query = query.join(klupung.flask.models.AgendaItem.contents)
+            query = query.filter(
+                (klupung.flask.models.Content.text.like("%%%s%%" % text))
+                |
+                (klupung.flask.models.AgendaItem.subject.like("%%%s%%" % text)))
+            query = query.distinct()
 
     try:
         policymaker_ids = [int(v) for v in flask.request.args["policymaker"].split(",")]
@@ -464,16 +796,20 @@ def _issue_search_route():
         raise InvalidArgumentError(flask.request.args["policymaker"], "policymaker",
                                    expected="one or more comma-separated integers")
     else:
-        query = query.join(klupung.flask.models.AgendaItem, klupung.flask.models.Meeting)
+        if not is_agenda_item_joined:
+            query = query.join(klupung.flask.models.Issue.agenda_items)
+        query = query.join(klupung.flask.models.AgendaItem.meeting)
         query = query.filter(klupung.flask.models.Meeting.policymaker_id.in_(policymaker_ids))
         query = query.distinct()
 
     return _jsonified_resource_list(
         klupung.flask.models.Issue,
         _get_issue_resource,
-        sortable_fields=["latest_decision_date"],
+        sortable_fields=["latest_decision_date", "relevance"],
         do_paginate=True,
-        query=query)
+        query=query,
+        eager_options=_ISSUE_EAGER_OPTIONS,
+        sort_columns={"relevance": relevance})
 
 @v0.route("/policymaker/filter/")
 def _policymaker_filter_route():
@@ -542,7 +878,8 @@ def _issue_filter_route():
     else:
         query = query.filter(klupung.flask.models.Issue.slug == slug)
 
-    return _jsonified_query_results(query, _get_issue_resource)
+    return _jsonified_query_results(query, _get_issue_resource,
+                                    eager_options=_ISSUE_EAGER_OPTIONS)
 
 @v0.route("/issue/")
 @auto.doc()
@@ -550,14 +887,18 @@ def _issue_route():
     """Return a list of issues.
 
     GET parameters:
-        limit    - the maximum number of objects to return
-        offset   - the number of objects to skip from the beginning of the result set
-        order_by - the name of field by which the results are ordered
+        limit       - the maximum number of objects to return
+        offset      - the number of objects to skip from the beginning of the result set
+        after       - the cursor after which objects are returned, empty for the first
+                      page, replaces offset and page, see meta.next_cursor
+        total_count - false to leave meta.total_count null, which is faster
+        order_by    - the name of field by which the results are ordered
     """
     return _jsonified_resource_list(
         klupung.flask.models.Issue,
         _get_issue_resource,
-        sortable_fields=["last_modified_time", "latest_decision_date"])
+        sortable_fields=["last_modified_time", "latest_decision_date"],
+        eager_options=_ISSUE_EAGER_OPTIONS)
 
 @v0.route("/issue/<int:issue_id>/")
 @auto.doc()
@@ -566,7 +907,8 @@ def _issue_id_route(issue_id):
     return _jsonified_resource(
         klupung.flask.models.Issue,
         _get_issue_resource,
-        issue_id)
+        issue_id,
+        eager_options=_ISSUE_EAGER_OPTIONS)
 
 @v0.route("/meeting/")
 @auto.doc()
@@ -576,6 +918,9 @@ def _meeting_route():
     GET parameters:
         limit       - the maximum number of objects to return
         offset      - the number of objects to skip from the beginning of the result set
+        after       - the cursor after which objects are returned, empty for the first
+                      page, replaces offset and page, see meta.next_cursor
+        total_count - false to leave meta.total_count null, which is faster
         order_by    - the name of field by which the results are ordered
         policymaker - the id of the policymaker whose meetings should be returned
     """
@@ -597,7 +942,8 @@ def _meeting_route():
         klupung.flask.models.Meeting,
         _get_meeting_resource,
         sortable_fields=["date", "policymaker"],
-        query=query)
+        query=query,
+        eager_options=_MEETING_EAGER_OPTIONS)
 
 @v0.route("/meeting/<int:meeting_id>/")
 @auto.doc()
@@ -606,7 +952,8 @@ def _meeting_id_route(meeting_id):
     return _jsonified_resource(
         klupung.flask.models.Meeting,
         _get_meeting_resource,
-        meeting_id)
+        meeting_id,
+        eager_options=_MEETING_EAGER_OPTIONS)
 
 @v0.route("/meeting_document/")
 @auto.doc()
@@ -614,13 +961,17 @@ def _meeting_document_route():
     """Return a list of meeting documents.
 
     GET parameters:
-        limit    - the maximum number of objects to return
-        offset   - the number of objects to skip from the beginning of the result set
-        order_by - the name of field by which the results are ordered
+        limit       - the maximum number of objects to return
+        offset      - the number of objects to skip from the beginning of the result set
+        after       - the cursor after which objects are returned, empty for the first
+                      page, replaces offset and page, see meta.next_cursor
+        total_count - false to leave meta.total_count null, which is faster
+        order_by    - the name of field by which the results are ordered
     """
     return _jsonified_resource_list(
         klupung.flask.models.MeetingDocument,
-        _get_meeting_document_resource)
+        _get_meeting_document_resource,
+        eager_options=_MEETING_DOCUMENT_EAGER_OPTIONS)
 
 @v0.route("/meeting_document/<int:meeting_document_id>/")
 @auto.doc()
@@ -629,7 +980,8 @@ def _meeting_document_id_route(meeting_document_id):
     return _jsonified_resource(
         klupung.flask.models.MeetingDocument,
         _get_meeting_document_resource,
-        meeting_document_id)
+        meeting_document_id,
+        eager_options=_MEETING_DOCUMENT_EAGER_OPTIONS)
 
 @v0.route("/category/filter/")
 def _category_filter_route():
@@ -667,9 +1019,12 @@ def _category_route():
     """Return a list of issue categories.
 
     GET parameters:
-        limit    - the maximum number of objects to return
-        offset   - the number of objects to skip from the beginning of the result set
-        order_by - the name of field by which the results are ordered
+        limit       - the maximum number of objects to return
+        offset      - the number of objects to skip from the beginning of the result set
+        after       - the cursor after which objects are returned, empty for the first
+                      page, replaces offset and page, see meta.next_cursor
+        total_count - false to leave meta.total_count null, which is faster
+        order_by    - the name of field by which the results are ordered
     """
     return _jsonified_resource_list(
         klupung.flask.models.Category,
@@ -690,9 +1045,12 @@ def _video_route():
     """Return a list of meeting videos.
 
     GET parameters:
-        limit    - the maximum number of objects to return
-        offset   - the number of objects to skip from the beginning of the result set
-        order_by - the name of field by which the results are ordered
+        limit       - the maximum number of objects to return
+        offset      - the number of objects to skip from the beginning of the result set
+        after       - the cursor after which objects are returned, empty for the first
+                      page, replaces offset and page, see meta.next_cursor
+        total_count - false to leave meta.total_count null, which is faster
+        order_by    - the name of field by which the results are ordered
     """
     return _jsonified_resource_list()
 
@@ -702,9 +1060,12 @@ def _district_route():
     """Return a list of districts related to an issue.
 
     GET parameters:
-        limit    - the maximum number of objects to return
-        offset   - the number of objects to skip from the beginning of the result set
-        order_by - the name of field by which the results are ordered
+        limit       - the maximum number of objects to return
+        offset      - the number of objects to skip from the beginning of the result set
+        after       - the cursor after which objects are returned, empty for the first
+                      page, replaces offset and page, see meta.next_cursor
+        total_count - false to leave meta.total_count null, which is faster
+        order_by    - the name of field by which the results are ordered
     """
     return _jsonified_resource_list()
 
@@ -714,12 +1075,21 @@ def _attachment_route():
     """Return a list of attachments of a meeting document.
 
     GET parameters:
-        limit    - the maximum number of objects to return
-        offset   - the number of objects to skip from the beginning of the result set
-        order_by - the name of field by which the results are ordered
+        limit       - the maximum number of objects to return
+        offset      - the number of objects to skip from the beginning of the result set
+        after       - the cursor after which objects are returned, empty for the first
+                      page, replaces offset and page, see meta.next_cursor
+        total_count - false to leave meta.total_count null, which is faster
+        order_by    - the name of field by which the results are ordered
     """
     return _jsonified_resource_list()
 
 @v0.errorhandler(Error)
 def _errorhandler(error):
-    return flask.jsonify(error=error.message), error.code
+    return _jsonify({"error": error.message}), error.code
+
+@v0.errorhandler(klupung.flask.spatial.IndexMissingError)
+def _index_missing_errorhandler(error):
+    # The database must be upgraded, let the administrator know.
+    flask.current_app.logger.error(str(error))
+    return _jsonify({"error": str(error)}), 500
@@ -0,0 +1,271 @@
+# KlupuNG
+# Copyright (C) 2014 Koodilehto Osk <http://koodilehto.fi>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Response cache and validators of the API
+
+Responses are cached by the data version, the path and the sorted
+query arguments of requests. Bumping the data version invalidates all
+cached responses at once, hence they can be cached until they are
+evicted or they expire after KLUPUNG_RESPONSE_CACHE_TIMEOUT seconds.
+
+For the same reason, responses are validated by an ETag made of the
+data version and a hash of the request, and by Last-Modified time of
+the data version. Conditional requests are answered with 304 only if
+the response would be 200, hence errors such as invalid arguments or
+missing resources are reported as usual. A cached response is known
+to be 200, so it is validated without querying the database for
+anything but the data version. So is a request with the current ETag
+in If-None-Match, because the ETag was given to a 200 response to the
+same request at the same data version.
+
+The cache has two tiers: an in-process LRU cache of at most
+KLUPUNG_RESPONSE_CACHE_THRESHOLD responses whose bodies total at most
+KLUPUNG_RESPONSE_CACHE_MAX_SIZE bytes, and optionally a shared cache
+given in KLUPUNG_SHARED_RESPONSE_CACHE. The shared cache can be
+any Werkzeug cache, e.g. FileSystemCache or MemcachedCache, shared by
+all worker processes.
+
+"""
+
+import collections
+import hashlib
+import threading
+import time
+
+import flask
+import werkzeug.contrib.cache
+
+import klupung.flask.models
+
+_EXTENSION_NAME = "klupung.flask.cache"
+
+_KEY_PREFIX = "klupung-response/"
+
+# Headers of a 200 response which are sent with 304 too, caches update
+# their stored responses with them (RFC 7232, section 4.1).
+_NOT_MODIFIED_HEADERS = ("Cache-Control", "ETag", "Expires", "Last-Modified",
+                         "Vary")
+
+class LRUCache(werkzeug.contrib.cache.BaseCache):
+    """Thread-safe in-memory cache which evicts the least recently used
+    items when it holds more than `threshold` items or the sizes of its
+    values, given by `get_size`, total more than `max_size`. A value
+    larger than `max_size` is not cached at all. Zero `max_size`
+    disables the size limit.
+
+    """
+
+    def __init__(self, threshold=500, max_size=0, get_size=len,
+                 default_timeout=300):
+        werkzeug.contrib.cache.BaseCache.__init__(self, default_timeout)
+        self._threshold = threshold
+        self._max_size = max_size
+        self._get_size = get_size
+        self._size = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _pop(self, key):
+        item = self._items.pop(key)
+        self._size -= item[2]
+        return item
+
+    def _push(self, key, item):
+        self._items[key] = item
+        self._size += item[2]
+
+    def get(self, key):
+        with self._lock:
+            try:
+                item = self._pop(key)
+            except KeyError:
+                return None
+            expires, value, _ = item
+            if expires and expires <= time.time():
+                return None
+            self._push(key, item)
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.time() + timeout if timeout else 0
+        size = self._get_size(value) if self._max_size else 0
+        with self._lock:
+            if key in self._items:
+                self._pop(key)
+            if size > self._max_size:
+                return
+            self._push(key, (expires, value, size))
+            while (len(self._items) > self._threshold
+                   or self._size > self._max_size):
+                self._pop(next(iter(self._items)))
+
+    def add(self, key, value, timeout=None):
+        if self.get(key) is not None:
+            return False
+        self.set(key, value, timeout)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._items:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+def _get_value_size(value):
+    data, _ = value
+    return len(data)
+
+def init_app(app):
+    caches = []
+    if app.config["KLUPUNG_RESPONSE_CACHE_THRESHOLD"]:
+        caches.append(LRUCache(app.config["KLUPUNG_RESPONSE_CACHE_THRESHOLD"],
+                               max_size=app.config["KLUPUNG_RESPONSE_CACHE_MAX_SIZE"],
+                               get_size=_get_value_size))
+    if app.config["KLUPUNG_SHARED_RESPONSE_CACHE"] is not None:
+        caches.append(app.config["KLUPUNG_SHARED_RESPONSE_CACHE"])
+    app.extensions[_EXTENSION_NAME] = caches
+
+def get_data_version():
+    """Return (version, modified_time) tuple of the data, queried once
+    per request.
+
+    """
+
+    if not hasattr(flask.g, "data_version"):
+        flask.g.data_version = klupung.flask.models.DataVersion.get()
+    return flask.g.data_version
+
+def _get_request_hash():
+    args = sorted(flask.request.args.iteritems(multi=True))
+    return hashlib.sha1(repr((flask.request.script_root, flask.request.path,
+                              args))).hexdigest()
+
+def _get_key():
+    version, _ = get_data_version()
+    # Memcached does not accept long keys or keys with whitespace.
+    return "%s%d/%s" % (_KEY_PREFIX, version, _get_request_hash())
+
+def _get_etag():
+    version, _ = get_data_version()
+    return "%d-%s" % (version, _get_request_hash())
+
+def _set_validators(response):
+    _, modified_time = get_data_version()
+    response.set_etag(_get_etag())
+    if modified_time is not None:
+        response.last_modified = modified_time
+
+def _is_not_modified():
+    if flask.request.if_none_match:
+        return _get_etag() in flask.request.if_none_match
+
+    _, modified_time = get_data_version()
+    if_modified_since = flask.request.if_modified_since
+    if if_modified_since is not None and modified_time is not None:
+        return modified_time <= if_modified_since
+
+    return False
+
+def _has_current_etag():
+    """Return True if If-None-Match of the current request has the
+    current ETag, not counting "*".
+
+    """
+
+    if_none_match = flask.request.if_none_match
+    return not if_none_match.star_tag and if_none_match.contains(_get_etag())
+
+def _make_not_modified_response(response):
+    not_modified_response = flask.current_app.response_class(status=304)
+    for name in _NOT_MODIFIED_HEADERS:
+        if name in response.headers:
+            not_modified_response.headers[name] = response.headers[name]
+    return not_modified_response
+
+def get_response():
+    """Return 304 if the client has the response to the current request
+    already, the cached response, or None if the request must be
+    handled.
+
+    """
+
+    if flask.request.method != "GET":
+        return None
+
+    if _has_current_etag():
+        response = flask.current_app.response_class(status=304)
+        _set_validators(response)
+        return response
+
+    caches = flask.current_app.extensions[_EXTENSION_NAME]
+    if not caches:
+        return None
+
+    key = _get_key()
+    for i, cache in enumerate(caches):
+        value = cache.get(key)
+        if value is not None:
+            # Promote to the faster tiers.
+            timeout = flask.current_app.config["KLUPUNG_RESPONSE_CACHE_TIMEOUT"]
+            for faster_cache in caches[:i]:
+                faster_cache.set(key, value, timeout=timeout)
+            break
+    else:
+        return None
+
+    flask.g.is_response_cached = True
+    data, mimetype = value
+    return flask.current_app.response_class(data, mimetype=mimetype)
+
+def _cache_response(response):
+    caches = flask.current_app.extensions[_EXTENSION_NAME]
+    if (not caches
+        or response.direct_passthrough
+        or getattr(flask.g, "is_response_cached", False)):
+        return
+
+    key = _get_key()
+    value = response.get_data(), response.mimetype
+    timeout = flask.current_app.config["KLUPUNG_RESPONSE_CACHE_TIMEOUT"]
+    for cache in caches:
+        cache.set(key, value, timeout=timeout)
+
+def set_response(response):
+    """Set validators of the response to the current request and cache
+    it if it is cacheable. Return the response, or 304 if the client
+    has it already.
+
+    Only successful responses are validated and cached, errors are
+    returned as they are.
+
+    """
+
+    if flask.request.method != "GET" or response.status_code != 200:
+        return response
+
+    _set_validators(response)
+    _cache_response(response)
+
+    if _is_not_modified():
+        return _make_not_modified_response(response)
+
+    return response
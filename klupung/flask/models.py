@@ -70,6 +70,7 @@ class AgendaItem(klupung.flask.db.Model):
     issue_id = klupung.flask.db.Column(
         klupung.flask.db.Integer,
         klupung.flask.db.ForeignKey("issue.id"),
+        index=True,
         )
     meeting_id = klupung.flask.db.Column(
         klupung.flask.db.Integer,
@@ -91,9 +92,11 @@ class AgendaItem(klupung.flask.db.Model):
         default=klupung.flask.db.func.now(),
         onupdate=klupung.flask.db.func.now(),
         nullable=False,
+        index=True,
         )
     origin_last_modified_time = klupung.flask.db.Column(
         klupung.flask.db.DateTime,
+        index=True,
         )
     permalink = klupung.flask.db.Column(
         klupung.flask.db.String(500),
@@ -108,6 +111,7 @@ class AgendaItem(klupung.flask.db.Model):
     contents = klupung.flask.db.relationship(
         "Content",
         backref="agenda_item",
+        order_by="Content.index",
         )
     # Relationships
     geometries = klupung.flask.db.relationship(
@@ -115,6 +119,7 @@ class AgendaItem(klupung.flask.db.Model):
         backref="agenda_item",
         )
 
+    # The unique constraint indexes meeting_id too.
     __table_args__ = (
         klupung.flask.db.CheckConstraint(index >= 0, name="check_index_positive"),
         klupung.flask.db.UniqueConstraint("meeting_id", "index"),
@@ -157,6 +162,14 @@ class Category(klupung.flask.db.Model):
         klupung.flask.db.ForeignKey("category.id"),
         nullable=True, # Top-level category does not have a parent
                        # category.
+        index=True,
+        )
+    # Materialized root of the ancestry, see update_ancestry(). Top-level
+    # category is its own top category.
+    top_category_id = klupung.flask.db.Column(
+        klupung.flask.db.Integer,
+        klupung.flask.db.ForeignKey("category.id"),
+        index=True,
         )
 
     # Relationships
@@ -168,6 +181,16 @@ class Category(klupung.flask.db.Model):
     parent = klupung.flask.db.relationship(
         "Category",
         uselist=False,
+        remote_side=[id],
+        foreign_keys=[parent_id],
+        )
+
+    top_category = klupung.flask.db.relationship(
+        "Category",
+        uselist=False,
+        remote_side=[id],
+        foreign_keys=[top_category_id],
+        post_update=True,
         )
 
     __table_args__ = (
@@ -179,14 +202,40 @@ class Category(klupung.flask.db.Model):
         self.origin_id = origin_id
         self.parent = parent
         self.level = 0
+        self.top_category = self
         if self.parent is not None:
-            self.level = klupung.flask.models.Category.query.filter_by(parent=parent).first().level + 1
+            self.level = self.parent.level + 1
+            self.top_category = self.parent.top_category
 
     def find_top_category(self):
+        if self.top_category is not None:
+            return self.top_category
         if self.parent:
             return self.parent.find_top_category()
         return self
 
+    @classmethod
+    def update_ancestry(cls):
+        """Update levels and top categories of all categories.
+
+        Must be called whenever parents of existing categories change.
+
+        """
+
+        # Ids and parent ids of pending changes are needed below.
+        klupung.flask.db.session.flush()
+
+        categories = cls.query.all()
+        categories_by_id = dict((c.id, c) for c in categories)
+        for category in categories:
+            level = 0
+            top_category = category
+            while top_category.parent_id is not None:
+                top_category = categories_by_id[top_category.parent_id]
+                level += 1
+            category.level = level
+            category.top_category_id = top_category.id
+
 class Issue(klupung.flask.db.Model):
     __tablename__ = "issue"
 
@@ -211,16 +260,19 @@ class Issue(klupung.flask.db.Model):
         klupung.flask.db.Integer,
         klupung.flask.db.ForeignKey("category.id"),
         nullable=False,
+        index=True,
         )
     last_modified_time = klupung.flask.db.Column(
         klupung.flask.db.DateTime,
         default=klupung.flask.db.func.now(),
         onupdate=klupung.flask.db.func.now(),
         nullable=False,
+        index=True,
         )
     latest_decision_date = klupung.flask.db.Column(
         klupung.flask.db.DateTime,
         nullable=False,
+        index=True,
         )
     slug = klupung.flask.db.Column(
         klupung.flask.db.String,
@@ -257,12 +309,19 @@ class Meeting(klupung.flask.db.Model):
     date = klupung.flask.db.Column(
         klupung.flask.db.DateTime,
         nullable=False,
+        index=True,
         )
     policymaker_id = klupung.flask.db.Column(
         klupung.flask.db.Integer,
         klupung.flask.db.ForeignKey("policymaker.id"),
         nullable=False,
         )
+    # Sequence number of the meeting among the meetings of the same
+    # policymaker in the same year, see renumber().
+    number = klupung.flask.db.Column(
+        klupung.flask.db.Integer,
+        index=True,
+        )
 
     # Relationships
     meeting_documents = klupung.flask.db.relationship(
@@ -274,6 +333,7 @@ class Meeting(klupung.flask.db.Model):
         backref="meeting",
         )
 
+    # The unique constraint indexes policymaker_id too.
     __table_args__ = (
         klupung.flask.db.UniqueConstraint("policymaker_id", "date"),
         )
@@ -282,12 +342,28 @@ class Meeting(klupung.flask.db.Model):
         self.date = date
         self.policymaker = policymaker
 
-    @property
-    def number(self):
-        jan1 = datetime.date(self.date.year, 1, 1)
-        return klupung.flask.models.Meeting.query.filter(
-            klupung.flask.models.Meeting.date>=jan1,
-            klupung.flask.models.Meeting.date<=self.date).count()
+    @classmethod
+    def renumber(cls, policymaker_id, year):
+        """Number meetings of the policymaker in the year by their dates,
+        starting from 1.
+
+        Must be called whenever meetings are inserted or deleted.
+
+        """
+
+        jan1 = datetime.datetime(year, 1, 1)
+        next_jan1 = datetime.datetime(year + 1, 1, 1)
+        meeting_ids = klupung.flask.db.session.query(cls.id).filter(
+            cls.policymaker_id == policymaker_id,
+            cls.date >= jan1,
+            cls.date < next_jan1).order_by(cls.date).all()
+        if not meeting_ids:
+            return
+        klupung.flask.db.session.execute(
+            cls.__table__.update().where(
+                cls.id == klupung.flask.db.bindparam("b_id")),
+            [{"b_id": meeting_id, "number": number}
+             for number, (meeting_id,) in enumerate(meeting_ids, 1)])
 
 class MeetingDocument(klupung.flask.db.Model):
     __tablename__ = "meeting_document"
@@ -301,6 +377,7 @@ class MeetingDocument(klupung.flask.db.Model):
         klupung.flask.db.Integer,
         klupung.flask.db.ForeignKey("meeting.id"),
         nullable=False,
+        index=True,
         )
     origin_url = klupung.flask.db.Column(
         klupung.flask.db.Text,
@@ -312,16 +389,24 @@ class MeetingDocument(klupung.flask.db.Model):
     publish_datetime = klupung.flask.db.Column(
         klupung.flask.db.DateTime,
         )
+    # Fingerprint of the source files the document was imported from,
+    # see klupung.ktweb.compute_meeting_document_fingerprint().
+    fingerprint = klupung.flask.db.Column(
+        klupung.flask.db.String(40),
+        nullable=True,
+        )
 
     __table_args__ = (
         klupung.flask.db.UniqueConstraint("origin_id"),
         )
 
-    def __init__(self, origin_url, meeting, origin_id, publish_datetime):
+    def __init__(self, origin_url, meeting, origin_id, publish_datetime,
+                 fingerprint=None):
         self.origin_url = origin_url
         self.meeting = meeting
         self.origin_id = origin_id
         self.publish_datetime = publish_datetime
+        self.fingerprint = fingerprint
 
 class Policymaker(klupung.flask.db.Model):
     __tablename__ = "policymaker"
@@ -403,6 +488,7 @@ class Content(klupung.flask.db.Model):
         klupung.flask.db.ForeignKey("agenda_item.id"),
         )
 
+    # The unique constraint indexes agenda_item_id too.
     __table_args__ = (
         klupung.flask.db.CheckConstraint(index >= 0, name="check_index_positive"),
         klupung.flask.db.UniqueConstraint("agenda_item_id", "index"),
@@ -464,6 +550,7 @@ class AgendaItemGeometry(klupung.flask.db.Model):
         nullable=False,
         )
 
+    # The unique constraint indexes agenda_item_id too.
     __table_args__ = (
         klupung.flask.db.UniqueConstraint("agenda_item_id", "name"),
         )
@@ -474,3 +561,55 @@ class AgendaItemGeometry(klupung.flask.db.Model):
         self.type = type
         self.name = name
         self.coordinates = coordinates
+
+class DataVersion(klupung.flask.db.Model):
+    """Single row counting modifications of the data
+
+    Caches of API responses are keyed by the version, hence every
+    transaction which modifies the data must call bump().
+
+    """
+
+    __tablename__ = "data_version"
+
+    # Columns
+    id = klupung.flask.db.Column(
+        klupung.flask.db.Integer,
+        primary_key=True,
+        )
+    version = klupung.flask.db.Column(
+        klupung.flask.db.Integer,
+        nullable=False,
+        )
+    modified_time = klupung.flask.db.Column(
+        klupung.flask.db.DateTime,
+        default=klupung.flask.db.func.now(),
+        onupdate=klupung.flask.db.func.now(),
+        nullable=False,
+        )
+
+    _ID = 1
+
+    @classmethod
+    def bump(cls):
+        """Increase the data version by one."""
+
+        if not cls.query.filter(cls.id == cls._ID).update(
+            {cls.version: cls.version + 1}, synchronize_session=False):
+            data_version = cls()
+            data_version.id = cls._ID
+            data_version.version = 1
+            klupung.flask.db.session.add(data_version)
+
+    @classmethod
+    def get(cls):
+        """Return (version, modified_time) tuple of the data, (0, None) if
+        the data has never been modified.
+
+        """
+
+        row = klupung.flask.db.session.query(
+            cls.version, cls.modified_time).filter(cls.id == cls._ID).first()
+        if row is None:
+            return 0, None
+        return tuple(row)
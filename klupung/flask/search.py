@@ -0,0 +1,163 @@
+# KlupuNG
+# Copyright (C) 2013 Koodilehto Osk <http://koodilehto.fi>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Full-text search index of agenda items
+
+The index is an SQLite FTS5 table of agenda item subjects and contents,
+kept up to date by the importer. If the database does not have the
+index, because it is not SQLite or its SQLite lacks FTS5, callers are
+expected to fall back to plain LIKE matching.
+
+Finnish is heavily inflected, hence every search term is matched as a
+prefix: 'kaava' matches 'kaavan' and 'kaavoitus' alike.
+
+"""
+
+import HTMLParser
+import re
+
+import sqlalchemy
+
+import klupung.flask
+import klupung.flask.models
+import klupung.flask.sqlite
+
+INDEX_TABLE_NAME = "agenda_item_search"
+
+# Diacritics are significant in Finnish, a and a with umlaut are different
+# letters.
+_CREATE_INDEX_SQL = """CREATE VIRTUAL TABLE %s USING fts5(
+    subject,
+    text,
+    issue_id UNINDEXED,
+    tokenize = "unicode61 remove_diacritics 0"
+)""" % INDEX_TABLE_NAME
+
+# Core table for building queries, it is not part of the model
+# metadata since it cannot be created with CREATE TABLE. Rowids are
+# agenda item ids. Hidden columns rank and agenda_item_search are
+# provided by FTS5 for ordering and matching.
+_metadata = sqlalchemy.MetaData()
+_index_table = sqlalchemy.Table(
+    INDEX_TABLE_NAME, _metadata,
+    sqlalchemy.Column("rowid", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("subject", sqlalchemy.Text),
+    sqlalchemy.Column("text", sqlalchemy.Text),
+    sqlalchemy.Column("issue_id", sqlalchemy.Integer),
+    sqlalchemy.Column("rank", sqlalchemy.Float),
+    sqlalchemy.Column(INDEX_TABLE_NAME, sqlalchemy.Text),
+    )
+
+_TAG_RE = re.compile(r"<[^>]*>")
+_TERM_RE = re.compile(r"\w+", re.UNICODE)
+
+_index = klupung.flask.sqlite.VirtualTable(INDEX_TABLE_NAME, _CREATE_INDEX_SQL)
+
+def create_index(connection):
+    """Create the index if the database supports it and it does not exist
+    yet. Return True if the index was created.
+
+    """
+
+    return _index.create(connection)
+
+def has_index(bind=None):
+    return _index.exists(bind)
+
+def _html_to_text(html, _parser=HTMLParser.HTMLParser()):
+    return _parser.unescape(_TAG_RE.sub(" ", html))
+
+def unindex_agenda_items(agenda_item_ids):
+    """Remove agenda items from the index."""
+
+    if not has_index():
+        return
+    for chunk in klupung.flask.sqlite.iter_chunks(agenda_item_ids):
+        klupung.flask.db.session.execute(_index_table.delete().where(
+                _index_table.c.rowid.in_(chunk)))
+
+def index_agenda_items(agenda_item_ids):
+    """Add or replace agenda items in the index."""
+
+    if not has_index():
+        return
+
+    agenda_item_table = klupung.flask.models.AgendaItem.__table__
+    content_table = klupung.flask.models.Content.__table__
+
+    unindex_agenda_items(agenda_item_ids)
+
+    for chunk in klupung.flask.sqlite.iter_chunks(agenda_item_ids):
+        texts = {}
+        for agenda_item_id, text in klupung.flask.db.session.execute(
+            sqlalchemy.select([content_table.c.agenda_item_id,
+                               content_table.c.text]).where(
+                content_table.c.agenda_item_id.in_(chunk)).order_by(
+                content_table.c.index)):
+            texts.setdefault(agenda_item_id, []).append(_html_to_text(text))
+
+        rows = []
+        for agenda_item_id, subject, issue_id in klupung.flask.db.session.execute(
+            sqlalchemy.select([agenda_item_table.c.id,
+                               agenda_item_table.c.subject,
+                               agenda_item_table.c.issue_id]).where(
+                agenda_item_table.c.id.in_(chunk))):
+            rows.append({
+                    "rowid": agenda_item_id,
+                    "subject": subject,
+                    "text": u"\n".join(texts.get(agenda_item_id, [])),
+                    "issue_id": issue_id,
+                    })
+        if rows:
+            klupung.flask.db.session.execute(_index_table.insert(), rows)
+
+def rebuild_index():
+    """Index all agenda items."""
+
+    agenda_item_table = klupung.flask.models.AgendaItem.__table__
+
+    if not has_index():
+        return
+    klupung.flask.db.session.execute(_index_table.delete())
+    agenda_item_ids = [agenda_item_id for agenda_item_id, in
+                       klupung.flask.db.session.execute(
+            sqlalchemy.select([agenda_item_table.c.id]))]
+    index_agenda_items(agenda_item_ids)
+
+def make_match_query(text):
+    """Return FTS5 query string matching all terms of `text` as
+    prefixes, or None if `text` has no terms.
+
+    """
+
+    terms = _TERM_RE.findall(text)
+    if not terms:
+        return None
+    return u" ".join(u'"%s"*' % term for term in terms)
+
+def search_issues(match_query):
+    """Return a subquery of issue ids and their best ranks matching
+    `match_query`. Lower rank is more relevant.
+
+    """
+
+    return sqlalchemy.select([
+            _index_table.c.issue_id,
+            sqlalchemy.func.min(_index_table.c.rank).label("rank"),
+            ]).where(
+        _index_table.c[INDEX_TABLE_NAME].op("MATCH")(match_query)).where(
+        _index_table.c.issue_id != None).group_by(
+        _index_table.c.issue_id).alias("issue_search")
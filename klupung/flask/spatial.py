@@ -0,0 +1,159 @@
+# KlupuNG
+# Copyright (C) 2013 Koodilehto Osk <http://koodilehto.fi>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Spatial index of agenda item geometries
+
+The index is an SQLite R*Tree table of geometry bounding boxes, rebuilt
+by the geometry importer. Coordinates are stored as pickles the
+database cannot look inside, hence bounding box queries require the
+index. klupung-dbupgrade creates it in databases initialized by older
+versions.
+
+"""
+
+import sqlalchemy
+
+import klupung.flask
+import klupung.flask.models
+import klupung.flask.sqlite
+
+INDEX_TABLE_NAME = "agenda_item_geometry_bbox"
+
+class IndexMissingError(Exception):
+    """Raised when a query requires the index but the database does not
+    have it.
+
+    """
+
+    def __init__(self):
+        Exception.__init__(self, "Spatial index %s is missing, create it "
+                           "with klupung-dbupgrade." % INDEX_TABLE_NAME)
+
+# Rowids are agenda item geometry ids.
+_CREATE_INDEX_SQL = """CREATE VIRTUAL TABLE %s USING rtree(
+    id,
+    min_x, max_x,
+    min_y, max_y
+)""" % INDEX_TABLE_NAME
+
+# Core table for building queries, it is not part of the model
+# metadata since it cannot be created with CREATE TABLE.
+_metadata = sqlalchemy.MetaData()
+_index_table = sqlalchemy.Table(
+    INDEX_TABLE_NAME, _metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("min_x", sqlalchemy.Float),
+    sqlalchemy.Column("max_x", sqlalchemy.Float),
+    sqlalchemy.Column("min_y", sqlalchemy.Float),
+    sqlalchemy.Column("max_y", sqlalchemy.Float),
+    )
+
+_index = klupung.flask.sqlite.VirtualTable(INDEX_TABLE_NAME, _CREATE_INDEX_SQL)
+
+def create_index(connection):
+    """Create the index if the database supports it and it does not exist
+    yet. Return True if the index was created.
+
+    """
+
+    return _index.create(connection)
+
+def has_index(bind=None):
+    return _index.exists(bind)
+
+def _iter_points(coordinates):
+    if coordinates and isinstance(coordinates[0], (int, long, float)):
+        yield coordinates
+        return
+    for child_coordinates in coordinates:
+        for point in _iter_points(child_coordinates):
+            yield point
+
+def compute_bbox(coordinates):
+    """Return (min_x, min_y, max_x, max_y) of GeoJSON-style coordinates
+    of a point, line string or polygon, or None if there are no points.
+
+    """
+
+    points = list(_iter_points(coordinates))
+    if not points:
+        return None
+    xs = [point[0] for point in points]
+    ys = [point[1] for point in points]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def _select_geometries():
+    geometry_table = klupung.flask.models.AgendaItemGeometry.__table__
+    return klupung.flask.db.session.execute(sqlalchemy.select(
+            [geometry_table.c.id, geometry_table.c.coordinates]))
+
+def unindex_agenda_items(agenda_item_ids):
+    """Remove geometries of agenda items from the index. Call this before
+    the geometries are deleted, SQLite reuses their ids.
+
+    """
+
+    if not has_index():
+        return
+    geometry_table = klupung.flask.models.AgendaItemGeometry.__table__
+    for chunk in klupung.flask.sqlite.iter_chunks(agenda_item_ids):
+        klupung.flask.db.session.execute(_index_table.delete().where(
+                _index_table.c.id.in_(sqlalchemy.select([geometry_table.c.id]).where(
+                        geometry_table.c.agenda_item_id.in_(chunk)))))
+
+def rebuild_index():
+    """Replace the contents of the index with bounding boxes of all
+    agenda item geometries.
+
+    """
+
+    if not has_index():
+        return
+
+    klupung.flask.db.session.execute(_index_table.delete())
+
+    rows = []
+    for geometry_id, coordinates in _select_geometries():
+        bbox = compute_bbox(coordinates)
+        if bbox is None:
+            continue
+        min_x, min_y, max_x, max_y = bbox
+        rows.append({
+                "id": geometry_id,
+                "min_x": min_x,
+                "max_x": max_x,
+                "min_y": min_y,
+                "max_y": max_y,
+                })
+    if rows:
+        klupung.flask.db.session.execute(_index_table.insert(), rows)
+
+def intersects_bbox(geometry_id_column, min_x, min_y, max_x, max_y):
+    """Return a filter criterion matching geometries whose bounding boxes
+    intersect the given bounding box.
+
+    Raises `IndexMissingError` if the database does not have the index.
+
+    """
+
+    if not has_index():
+        raise IndexMissingError()
+
+    return geometry_id_column.in_(sqlalchemy.select([_index_table.c.id]).where(
+            (_index_table.c.min_x <= max_x)
+            & (_index_table.c.max_x >= min_x)
+            & (_index_table.c.min_y <= max_y)
+            & (_index_table.c.max_y >= min_y)))
@@ -0,0 +1,94 @@
+# KlupuNG
+# Copyright (C) 2014 Koodilehto Osk <http://koodilehto.fi>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""SQLite limits and optional virtual tables
+
+SQLite limits the number of host parameters per statement, hence
+values of long IN clauses are bound in chunks.
+
+Indexes which SQLite does not provide natively are virtual tables of
+extension modules, e.g. FTS5 or R*Tree, which may be missing from the
+SQLite library. They are created with the other tables if possible,
+and callers must check that they exist before using them.
+
+"""
+
+import sqlalchemy
+import sqlalchemy.exc
+
+import klupung.flask
+
+# Maximum number of values bound to a single IN clause.
+MAX_IN_VALUES = 500
+
+def iter_chunks(values):
+    """Yield lists of at most MAX_IN_VALUES distinct values of `values`."""
+
+    values = list(set(values))
+    for i in range(0, len(values), MAX_IN_VALUES):
+        yield values[i:i + MAX_IN_VALUES]
+
+class VirtualTable(object):
+    """Virtual table created by `create_sql` when the tables of the
+    models are created.
+
+    """
+
+    def __init__(self, name, create_sql):
+        self.name = name
+        self._create_sql = create_sql
+
+        # Existence by engine, a table created while the application is
+        # running is noticed only after restart.
+        self._exists_cache = {}
+
+        sqlalchemy.event.listen(klupung.flask.db.metadata, "after_create",
+                                self._create_after_create)
+
+    def create(self, connection):
+        """Create the table if the database supports it and it does not
+        exist yet. Return True if the table was created.
+
+        """
+
+        if connection.dialect.name != "sqlite" or self.exists(connection):
+            return False
+        try:
+            connection.execute(self._create_sql)
+        except sqlalchemy.exc.OperationalError:
+            # SQLite without the extension module.
+            return False
+        self._exists_cache.pop(connection.engine, None)
+        return True
+
+    def _create_after_create(self, target, connection, **kwargs):
+        self.create(connection)
+
+    def exists(self, bind=None):
+        if bind is None:
+            bind = klupung.flask.db.engine
+        engine = bind.engine
+        try:
+            return self._exists_cache[engine]
+        except KeyError:
+            pass
+        result = False
+        if engine.dialect.name == "sqlite":
+            result = bind.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name=?",
+                self.name).scalar() > 0
+        self._exists_cache[engine] = result
+        return result
@@ -16,6 +16,19 @@
 
 import os
 
+import werkzeug.contrib.cache
+
 import klupung.flask
 
-app = klupung.flask.create_app(os.environ["KLUPUNG_DB_URI"])
+config = {}
+
+# Response cache shared by worker processes, either a directory or a
+# comma-separated list of memcached servers.
+if os.environ.get("KLUPUNG_RESPONSE_CACHE_DIR"):
+    config["KLUPUNG_SHARED_RESPONSE_CACHE"] = werkzeug.contrib.cache.FileSystemCache(
+        os.environ["KLUPUNG_RESPONSE_CACHE_DIR"], threshold=5000)
+elif os.environ.get("KLUPUNG_RESPONSE_CACHE_SERVERS"):
+    config["KLUPUNG_SHARED_RESPONSE_CACHE"] = werkzeug.contrib.cache.MemcachedCache(
+        os.environ["KLUPUNG_RESPONSE_CACHE_SERVERS"].split(","))
+
+app = klupung.flask.create_app(os.environ["KLUPUNG_DB_URI"], config)
@@ -19,23 +19,38 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import absolute_import
 
+import codecs
+import collections
+import cPickle as pickle
 import datetime
 import errno
+import functools
 import glob
+import hashlib
+import httplib
+import json
+import multiprocessing
 import os
 import os.path
+import random
 import re
+import socket
 import sys
 import tempfile
+import threading
 import time
 import traceback
 
 from codecs import open
+from cStringIO import StringIO
+from HTMLParser import HTMLParser
+from multiprocessing.pool import ThreadPool
 
-from urllib2 import urlopen
+from urllib2 import HTTPError
 from urlparse import urljoin, urlsplit
 
 import bs4
+import bs4.builder
 
 _COVER_PAGE_FILENAME = "htmtxt0.htm"
 
@@ -46,34 +61,156 @@ def is_meeting_document_dir(dirpath):
         break
     return True
 
+PARSER_BACKENDS = (
+    PARSER_BACKEND_LXML,
+    PARSER_BACKEND_HTMLPARSER,
+    PARSER_BACKEND_HTML5LIB,
+    ) = (
+    "lxml",
+    "html.parser",
+    "html5lib",
+    )
+
+def _is_parser_backend_available(parser_backend):
+    return bs4.builder.builder_registry.lookup(parser_backend) is not None
+
+def _find_default_parser_backend():
+    # lxml is by far the fastest, html.parser from the standard library
+    # is always available.
+    if _is_parser_backend_available(PARSER_BACKEND_LXML):
+        return PARSER_BACKEND_LXML
+    return PARSER_BACKEND_HTMLPARSER
+
+_parser_backend = _find_default_parser_backend()
+
+def get_parser_backend():
+    """Return the name of the parser backend used to build soups"""
+    return _parser_backend
+
+def set_parser_backend(parser_backend):
+    """Set the parser backend used to build soups.
+
+    `parser_backend` must be one of PARSER_BACKENDS. Raises `ValueError`
+    if the backend is unknown or not installed.
+
+    """
+
+    global _parser_backend
+
+    if parser_backend not in PARSER_BACKENDS:
+        raise ValueError("parser_backend has invalid value (%r), expected %s" %
+                         (parser_backend,
+                          " or ".join([repr(s) for s in PARSER_BACKENDS])))
+    if not _is_parser_backend_available(parser_backend):
+        raise ValueError("parser backend %r is not installed" % parser_backend)
+    _parser_backend = parser_backend
+
 def _make_soup(filepath, encoding="utf-8"):
     with open(filepath, encoding=encoding, errors="replace") as f:
-        return bs4.BeautifulSoup(f, from_encoding=encoding)
+        # The markup is already decoded, hence from_encoding would be
+        # pointless (and rejected by html5lib).
+        return bs4.BeautifulSoup(f, _parser_backend)
 
-def _cleanup_soup(soup):
-    for tag in soup.find_all(text=lambda t: isinstance(t, bs4.Comment)):
-        tag.extract()
+class _HTMLCleaner(HTMLParser):
+    """Streaming HTML filter.
 
-    for tag in soup.find_all(text=lambda t: isinstance(t, bs4.Declaration)):
-        tag.extract()
+    Passes the fed markup through to `write`, except comments,
+    declarations, processing instructions, style elements and meta
+    elements, which are stripped. Only class, href and target attributes
+    are kept. Carriage returns are removed from the text.
 
-    for tag in soup("style"):
-        tag.extract()
+    """
 
-    for tag in soup("meta"):
-        tag.extract()
+    _SAVED_ATTRS = set(["class", "href", "target"])
 
-    for tag in soup.find_all():
-        attrs = tag.attrs
-        saved_attrs = set(["class", "href", "target"]) & set(attrs.keys())
-        tag.attrs = {a: attrs[a] for a in saved_attrs}
+    _STRIPPED_TAGS = set(["meta", "style"])
 
-    for tag in soup.find_all(text=True):
-        tag.replace_with(re.sub(r"\r", "", tag.string))
+    def __init__(self, write):
+        HTMLParser.__init__(self)
+        self._write = write
+        self._style_depth = 0
 
-    return soup
+    def _write_starttag(self, tag, attrs, end):
+        if tag == "style" and end == u">":
+            self._style_depth += 1
+        if tag in self._STRIPPED_TAGS or self._style_depth:
+            return
+        self._write(u"<%s" % tag)
+        for name, value in attrs:
+            if name in self._SAVED_ATTRS and value is not None:
+                value = value.replace(u"&", u"&amp;").replace(u"<", u"&lt;")
+                value = value.replace(u">", u"&gt;").replace(u'"', u"&quot;")
+                self._write(u' %s="%s"' % (name, value))
+        self._write(end)
 
-def _print_to_file(filepath, printable):
+    def handle_starttag(self, tag, attrs):
+        self._write_starttag(tag, attrs, u">")
+
+    def handle_startendtag(self, tag, attrs):
+        self._write_starttag(tag, attrs, u"/>")
+
+    def handle_endtag(self, tag):
+        if tag == "style":
+            self._style_depth = max(self._style_depth - 1, 0)
+            return
+        if tag in self._STRIPPED_TAGS or self._style_depth:
+            return
+        self._write(u"</%s>" % tag)
+
+    def handle_data(self, data):
+        if not self._style_depth:
+            self._write(data.replace(u"\r", u""))
+
+    def handle_entityref(self, name):
+        if not self._style_depth:
+            self._write(u"&%s;" % name)
+
+    def handle_charref(self, name):
+        if not self._style_depth:
+            self._write(u"&#%s;" % name)
+
+    def handle_comment(self, data):
+        pass
+
+    def handle_decl(self, decl):
+        pass
+
+    def handle_pi(self, data):
+        pass
+
+    def unknown_decl(self, data):
+        pass
+
+_CLEAN_HTML_CHUNK_SIZE = 16 * 1024
+
+def _clean_html(in_file, out_file, encoding="utf-8"):
+    """Clean HTML read from `in_file` chunk by chunk and write it to
+    `out_file` as UTF-8 while reading.
+
+    Return the SHA-1 hex digest of the written content.
+
+    """
+
+    sha1 = hashlib.sha1()
+
+    def write(text):
+        data = text.encode("utf-8")
+        sha1.update(data)
+        out_file.write(data)
+
+    cleaner = _HTMLCleaner(write)
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    while True:
+        chunk = in_file.read(_CLEAN_HTML_CHUNK_SIZE)
+        if not chunk:
+            break
+        cleaner.feed(decoder.decode(chunk))
+    cleaner.feed(decoder.decode("", final=True))
+    cleaner.close()
+
+    return sha1.hexdigest()
+
+def _make_tmp_file(filepath):
     # Make the target directory with all the leading components, do not
     # care whether the the directory exists or not.
     dirpath = os.path.dirname(filepath)
@@ -83,13 +220,16 @@ def _print_to_file(filepath, printable):
         if e.errno != errno.EEXIST:
             raise e
 
+    return tempfile.NamedTemporaryFile(dir=dirpath, delete=False)
+
+def _print_to_file(filepath, printable):
     # Write the contents to a temporary file first, because the
     # existence of the real filepath can be used as an indicator to not
     # re-download and re-write the file again but just read its current
     # value. Writing to a temporary file and then renaming it to its
     # final name guarantees that the contents of the final path is
     # always complete.
-    tmp_file = tempfile.NamedTemporaryFile(dir=dirpath, delete=False)
+    tmp_file = _make_tmp_file(filepath)
     try:
         print(printable, file=tmp_file)
         tmp_file.close()
@@ -109,41 +249,616 @@ def _print_to_file(filepath, printable):
             os.remove(tmp_file.name)
             raise
 
-_last_download_time = None
+class _RateLimiter(object):
+    """Thread-safe per-host request rate limiter.
+
+    Each host has a token bucket which holds at most one token and is
+    refilled once every `min_interval` seconds. A request must take a
+    token before it is sent, hence requests to the same host are at
+    least `min_interval` seconds apart regardless of how many threads
+    are downloading concurrently.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_token_times = {}
+
+    def wait(self, url, min_interval):
+        """Wait for a token for a request to `url` and return the time the
+        token was scheduled for.
+
+        """
+
+        host = urlsplit(url).netloc
+
+        # Reserve the next free token while holding the lock, but sleep
+        # without it to let other threads reserve their tokens too.
+        with self._lock:
+            now = time.time()
+            token_time = max(self._next_token_times.get(host, now), now)
+            self._next_token_times[host] = token_time + min_interval
+
+        time.sleep(token_time - now)
+
+        return token_time
+
+_rate_limiter = _RateLimiter()
+
+class _ConnectionPool(object):
+    """Thread-safe pool of persistent HTTP connections.
+
+    Connections are kept alive between requests and reused for
+    subsequent requests to the same host, which saves a TCP (and TLS)
+    handshake per page. At most `size` idle connections are kept per
+    host and connections idle for longer than `idle_timeout` seconds
+    are closed instead of reused. Blocking socket operations time out
+    after `timeout` seconds.
+
+    """
+
+    _MAX_REDIRECTS = 5
+
+    def __init__(self, size=4, idle_timeout=30, timeout=60):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle_connections = {}
+
+    def _connect(self, scheme, netloc):
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _acquire(self, scheme, netloc):
+        now = time.time()
+        with self._lock:
+            idle_connections = self._idle_connections.get((scheme, netloc), [])
+            while idle_connections:
+                connection, release_time = idle_connections.pop()
+                if now - release_time < self.idle_timeout:
+                    return connection, True
+                connection.close()
+        return self._connect(scheme, netloc), False
+
+    def _release(self, scheme, netloc, connection):
+        with self._lock:
+            idle_connections = self._idle_connections.setdefault((scheme, netloc), [])
+            if len(idle_connections) < self.size:
+                idle_connections.append((connection, time.time()))
+                return
+        connection.close()
+
+    def _request(self, url, headers, consume_body, min_interval):
+        scheme, netloc, path, query, _ = urlsplit(url)
+        if query:
+            path = "%s?%s" % (path, query)
+
+        connection, is_reused = self._acquire(scheme, netloc)
+        while True:
+            _rate_limiter.wait(url, min_interval)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, EnvironmentError):
+                connection.close()
+                if not is_reused:
+                    raise
+                # The server has probably closed the idle connection,
+                # retry once with a fresh connection.
+                connection, is_reused = self._connect(scheme, netloc), False
+            else:
+                break
+
+        try:
+            if 200 <= response.status < 300:
+                body = consume_body(response)
+            else:
+                body = response.read()
+        except:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(scheme, netloc, connection)
+
+        return response, body
+
+    def get(self, url, headers={}, consume_body=lambda response: response.read(),
+            min_interval=0):
+        """Return a tuple (response, body) for `url`
+
+        The body of a successful response is read by calling
+        `consume_body` with the response and body is its return value.
+        By default, the whole body is read to a string.
+
+        Every request waits for a rate limiter token of its host, see
+        _RateLimiter and `min_interval`. That includes redirects and
+        requests sent again over a fresh connection.
+
+        Redirects are followed. Raises `urllib2.HTTPError` if the server
+        responds with an error status. Note that the status of the
+        returned response can be 304 Not Modified if `headers` contain
+        conditional request headers.
+
+        """
+
+        for _ in range(self._MAX_REDIRECTS + 1):
+            response, body = self._request(url, headers, consume_body,
+                                           min_interval)
+            location = response.getheader("location")
+            if response.status in (301, 302, 303, 307) and location:
+                url = urljoin(url, location)
+                continue
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason,
+                                response.msg, None)
+            return response, body
+
+        raise HTTPError(url, response.status, "Too many redirects",
+                        response.msg, None)
+
+    def close(self):
+        with self._lock:
+            for idle_connections in self._idle_connections.values():
+                for connection, _ in idle_connections:
+                    connection.close()
+            self._idle_connections.clear()
+
+_connection_pool = _ConnectionPool()
+
+def configure_connection_pool(size=4, idle_timeout=30, timeout=60):
+    """Set the connection pool options of all download functions.
+
+    `size` is the maximum number of idle connections kept alive per
+    host, it should be at least the download concurrency. Connections
+    idle for longer than `idle_timeout` seconds are not reused. Requests
+    time out after `timeout` seconds.
+
+    """
+
+    global _connection_pool
+
+    old_connection_pool = _connection_pool
+    _connection_pool = _ConnectionPool(size=size, idle_timeout=idle_timeout,
+                                       timeout=timeout)
+    old_connection_pool.close()
+
+class HostUnavailableError(Exception):
+    """Raised when a host is not requested anymore because too many
+    consecutive requests to it have failed."""
+
+    def __init__(self, host):
+        Exception.__init__(self, "Too many consecutive failed requests to "
+                           "host '%s'" % host)
+        self.host = host
+
+class _CircuitBreaker(object):
+    """Thread-safe per-host circuit breaker.
+
+    The circuit of a host opens after `max_failures` consecutive failed
+    requests, i.e. further requests to the host fail immediately with
+    `HostUnavailableError`. After `reset_timeout` seconds, the circuit
+    is half-open: a single trial request is let through, and it either
+    closes the circuit by succeeding or opens it again by failing. None
+    `reset_timeout` keeps the circuit open for good. Zero
+    `max_failures` disables the breaker.
+
+    """
+
+    def __init__(self, max_failures=10, reset_timeout=300):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._open_times = {}
+        self._half_open_hosts = set()
+
+    def check(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._open_times:
+                return
+            if (host in self._half_open_hosts
+                or self.reset_timeout is None
+                or time.time() - self._open_times[host] < self.reset_timeout):
+                raise HostUnavailableError(host)
+            self._half_open_hosts.add(host)
+
+    def record_success(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host in self._open_times and host not in self._half_open_hosts:
+                # Sent before the circuit opened, the host may still
+                # be down.
+                return
+            self._failures[host] = 0
+            self._open_times.pop(host, None)
+            self._half_open_hosts.discard(host)
+
+    def record_failure(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            failures = self._failures.get(host, 0) + 1
+            self._failures[host] = failures
+            if self.max_failures and failures >= self.max_failures:
+                self._open_times[host] = time.time()
+                self._half_open_hosts.discard(host)
+
+class _RetryPolicy(object):
+    """Retry transient request failures with jittered exponential backoff.
+
+    A failed request is retried at most `max_retries` times. Before the
+    nth retry, a random time between zero and min(`backoff` * 2^(n-1),
+    `max_backoff`) seconds is slept.
+
+    """
+
+    def __init__(self, max_retries=3, backoff=1, max_backoff=60):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def is_transient(self, error):
+        if isinstance(error, HTTPError):
+            # Server errors are often temporary, client errors are not.
+            return error.code >= 500
+        # Local I/O errors, e.g. a full disk while the body is written
+        # to a file, are not network failures and are not retried.
+        return isinstance(error, (httplib.HTTPException, socket.error))
+
+    def sleep(self, retry_number):
+        max_pause = min(self.backoff * 2 ** (retry_number - 1), self.max_backoff)
+        time.sleep(random.uniform(0, max_pause))
+
+_circuit_breaker = _CircuitBreaker()
+_retry_policy = _RetryPolicy()
+
+def configure_retries(max_retries=3, backoff=1, max_backoff=60, max_host_failures=10,
+                      host_reset_timeout=300):
+    """Set the retry options of all download functions.
+
+    Transiently failed requests are retried at most `max_retries` times
+    with jittered exponential backoff, starting from `backoff` seconds
+    and capped at `max_backoff` seconds. After `max_host_failures`
+    consecutive failed requests to a host, downloads from the host
+    raise `HostUnavailableError` until a trial request, sent after
+    `host_reset_timeout` seconds, succeeds. Zero `max_host_failures`
+    allows any number of failures.
+
+    """
+
+    global _circuit_breaker
+    global _retry_policy
+
+    _circuit_breaker = _CircuitBreaker(max_failures=max_host_failures,
+                                       reset_timeout=host_reset_timeout)
+    _retry_policy = _RetryPolicy(max_retries=max_retries, backoff=backoff,
+                                 max_backoff=max_backoff)
+
+def _get(url, min_interval=1, headers={}, **kwargs):
+    _circuit_breaker.check(url)
+
+    retry_number = 0
+    while True:
+        try:
+            response, body = _connection_pool.get(url, headers=headers,
+                                                  min_interval=min_interval,
+                                                  **kwargs)
+        except Exception, e:
+            if not _retry_policy.is_transient(e):
+                # The host is up even though it refused to serve the
+                # request or the response could not be saved locally.
+                _circuit_breaker.record_success(url)
+                raise
+            if retry_number >= _retry_policy.max_retries:
+                _circuit_breaker.record_failure(url)
+                raise
+            retry_number += 1
+            _retry_policy.sleep(retry_number)
+        else:
+            _circuit_breaker.record_success(url)
+            return response, body
+
+class RetryQueue(object):
+    """Thread-safe queue of failed downloads to be retried later.
+
+    A queued download is a function whose first argument is the URL
+    being downloaded. It must return a false value or raise if the
+    download fails.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._downloads = []
+
+    def __len__(self):
+        with self._lock:
+            return len(self._downloads)
+
+    def put(self, download, *args, **kwargs):
+        with self._lock:
+            self._downloads.append(functools.partial(download, *args, **kwargs))
+
+    def retry(self):
+        """Retry all queued downloads once and empty the queue.
+
+        Downloads from unavailable hosts are skipped. Return a list of
+        URLs of the downloads which failed again or were skipped.
+
+        """
+
+        with self._lock:
+            downloads = self._downloads
+            self._downloads = []
+
+        failed_urls = []
+        for download in downloads:
+            try:
+                is_success = download()
+            except HostUnavailableError:
+                is_success = False
+            if not is_success:
+                failed_urls.append(download.args[0])
+        return failed_urls
 
 def _download_clean_soup(url, encoding="utf-8", min_interval=1):
-    global _last_download_time
+    def clean(response):
+        clean_file = StringIO()
+        _clean_html(response, clean_file, encoding=encoding)
+        return clean_file.getvalue()
+
+    _, clean_html = _get(url, min_interval=min_interval, consume_body=clean)
+
+    return bs4.BeautifulSoup(clean_html, _parser_backend, from_encoding="utf-8")
+
+def _download_clean_page(url, filepath, encoding="utf-8", min_interval=1,
+                         validators={}):
+    """Download and clean `url` to a temporary file next to `filepath`
+
+    Return a tuple (tmp_filepath, validators). The page is cleaned while
+    it is downloaded, it is never parsed completely into memory.
 
-    if _last_download_time is not None:
-        pause = max(_last_download_time - time.time() + min_interval, 0)
-        time.sleep(pause)
+    If `validators` contain an ETag or a Last-Modified value of a
+    previously downloaded copy, the request is made conditional. When
+    the server responds 304 Not Modified, tmp_filepath is None. Returned
+    validators are the ones received from the server and the SHA-1 of
+    the cleaned page.
 
-    response = urlopen(url)
-    _last_download_time = time.time()
+    """
 
-    dirty_soup = bs4.BeautifulSoup(response, from_encoding=encoding)
-    clean_soup = _cleanup_soup(dirty_soup)
-    return clean_soup
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    def clean_to_tmp_file(response):
+        tmp_file = _make_tmp_file(filepath)
+        try:
+            sha1 = _clean_html(response, tmp_file, encoding=encoding)
+            tmp_file.close()
+        except:
+            try:
+                tmp_file.close()
+            finally:
+                os.remove(tmp_file.name)
+            raise
+        return tmp_file.name, sha1
+
+    response, body = _get(url, min_interval=min_interval, headers=headers,
+                          consume_body=clean_to_tmp_file)
+
+    if response.status == 304:
+        return None, validators
+
+    tmp_filepath, sha1 = body
+    new_validators = {
+        "etag": response.getheader("etag"),
+        "last_modified": response.getheader("last-modified"),
+        "sha1": sha1,
+        }
+
+    return tmp_filepath, new_validators
+
+_VALIDATORS_FILENAME_SUFFIX = ".validators"
+
+def _read_validators(filepath):
+    """Return validators of a downloaded page stored at `filepath`
+
+    Validators are stored next to the page. If they are missing but the
+    page exists, only the content hash is returned. If the page is
+    missing, its validators are useless, they are deleted and an empty
+    dict is returned, hence the page is requested unconditionally.
+
+    """
+
+    validators_filepath = filepath + _VALIDATORS_FILENAME_SUFFIX
+
+    if not os.path.exists(filepath):
+        try:
+            os.remove(validators_filepath)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise e
+        return {}
+
+    try:
+        with open(validators_filepath) as f:
+            return json.load(f)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise e
+    except ValueError:
+        # Corrupted validators are as good as none.
+        pass
+
+    with open(filepath) as f:
+        return {"sha1": hashlib.sha1(f.read()).hexdigest()}
+
+class DownloadManifest(object):
+    """Machine-readable record of downloaded pages.
+
+    The manifest is a JSON Lines file, each line describes one
+    downloaded page with keys "url", "path" (relative to the download
+    directory), "sha1" (hash of the saved content), "fetch_time" (UTC)
+    and "status", which is one of "new", "changed" or "unchanged".
+    Records are appended, hence consecutive downloads can share the
+    same manifest.
+
+    """
+
+    STATUSES = (
+        STATUS_NEW,
+        STATUS_CHANGED,
+        STATUS_UNCHANGED,
+        ) = (
+        "new",
+        "changed",
+        "unchanged",
+        )
+
+    def __init__(self, filepath):
+        self._lock = threading.Lock()
+        self._file = open(filepath, "a")
+
+    def record(self, url, path, sha1, status):
+        entry = json.dumps({
+                "url": url,
+                "path": path,
+                "sha1": sha1,
+                "fetch_time": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f"),
+                "status": status,
+                }, sort_keys=True)
+        with self._lock:
+            print(entry, file=self._file)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def read_download_manifest(manifest_filepath):
+    """Return a generator of records of a download manifest"""
+    with open(manifest_filepath) as manifest_file:
+        for line in manifest_file:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def query_changed_meeting_document_dirs(manifest_filepath, download_dir=os.path.curdir):
+    """Return a sorted list of meeting document directories which have new
+    or changed pages according to the download manifest.
+
+    """
+
+    changed_dirpaths = set()
+    for record in read_download_manifest(manifest_filepath):
+        if record["status"] == DownloadManifest.STATUS_UNCHANGED:
+            continue
+        dirpath = os.path.join(download_dir, os.path.dirname(record["path"]))
+        if dirpath in changed_dirpaths:
+            continue
+        if os.path.isdir(dirpath) and is_meeting_document_dir(dirpath):
+            changed_dirpaths.add(dirpath)
+    return sorted(changed_dirpaths)
+
+class CrawlState(object):
+    """Durable record of policymaker indexes and meeting documents
+    completely downloaded during a crawl.
+
+    The state is a JSON Lines file which is appended and synced to disk
+    whenever a policymaker index or a meeting document is done. If the
+    file exists when the state is created, its records are loaded,
+    hence a crawl restarted with the same file skips everything which
+    was already done. The file should be removed with `clear()` after
+    a complete crawl.
+
+    """
+
+    KINDS = (
+        KIND_POLICYMAKER,
+        KIND_MEETING_DOCUMENT,
+        ) = (
+        "policymaker",
+        "meeting_document",
+        )
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self._lock = threading.Lock()
+        self._done = set()
+
+        try:
+            with open(filepath) as state_file:
+                for line in state_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line can be incomplete if the
+                        # previous crawl died while writing it.
+                        continue
+                    self._done.add((record["kind"], record["url"]))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise e
+
+        self._file = open(filepath, "a")
+
+    def is_done(self, kind, url):
+        with self._lock:
+            return (kind, url) in self._done
+
+    def mark_done(self, kind, url):
+        record = json.dumps({"kind": kind, "url": url}, sort_keys=True)
+        with self._lock:
+            self._done.add((kind, url))
+            print(record, file=self._file)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+    def clear(self):
+        self.close()
+        os.remove(self._filepath)
 
 _DOWNLOAD_PAGE_ERROR_POLICIES = set(("raise", "ignore", "log"))
 _DOWNLOAD_PAGE_ERROR_POLICIES_STR = ' or '.join([repr(s) for s in _DOWNLOAD_PAGE_ERROR_POLICIES])
 def _download_page(url, encoding="utf-8", force=False, min_interval=1,
-                   download_dir=os.path.curdir, error_policy="raise"):
+                   download_dir=os.path.curdir, error_policy="raise",
+                   manifest=None, retry_queue=None):
     if error_policy not in _DOWNLOAD_PAGE_ERROR_POLICIES:
         raise ValueError("error_policy has invalid value (%r), expected %s" %
                          (error_policy, _DOWNLOAD_PAGE_ERROR_POLICIES_STR))
     filepath = os.path.normpath(download_dir + urlsplit(url).path)
     if force or not os.path.exists(filepath):
+        validators = _read_validators(filepath)
         try:
-            clean_soup = _download_clean_soup(url,
-                                              encoding=encoding,
-                                              min_interval=min_interval)
+            tmp_filepath, new_validators = _download_clean_page(
+                url,
+                filepath,
+                encoding=encoding,
+                min_interval=min_interval,
+                validators=validators)
+        except HostUnavailableError:
+            # Stop downloading from the host regardless of the policy.
+            raise
         except Exception, e:
             exc_info = sys.exc_info()
             if error_policy == "raise":
                 raise
+            if retry_queue is not None:
+                retry_queue.put(_download_page, url, encoding=encoding,
+                                force=True, min_interval=min_interval,
+                                download_dir=download_dir,
+                                error_policy=error_policy, manifest=manifest)
             if error_policy == "ignore":
-                return None, None
+                return None
             if error_policy == "log":
                 try:
                     os.makedirs(os.path.dirname(filepath))
@@ -152,31 +867,83 @@ def _download_page(url, encoding="utf-8", force=False, min_interval=1,
                         raise e
                 with open("%s.log" % filepath, "a") as error_log:
                     traceback.print_exception(*exc_info, file=error_log)
-                return None, None
-        _print_to_file(filepath, clean_soup)
-        return filepath, clean_soup
-    return filepath, None
-
-def download_meeting_document(meeting_document_url, min_interval=1, force=False, download_dir=os.path.curdir):
-    index_filepath, index_soup = _download_page(meeting_document_url,
-                                                encoding="iso-8859-1",
-                                                force=True, # Refresh indices always.
-                                                min_interval=min_interval,
-                                                download_dir=download_dir,
-                                                error_policy="log")
-    if index_filepath is index_soup is None:
-        return None
+                return None
+
+        if tmp_filepath is None:
+            # Not modified since the last download.
+            if manifest is not None:
+                manifest.record(url, os.path.relpath(filepath, download_dir),
+                                validators.get("sha1"),
+                                DownloadManifest.STATUS_UNCHANGED)
+            return filepath
+
+        if not os.path.exists(filepath):
+            status = DownloadManifest.STATUS_NEW
+        elif new_validators["sha1"] != validators.get("sha1"):
+            status = DownloadManifest.STATUS_CHANGED
+        else:
+            status = DownloadManifest.STATUS_UNCHANGED
+
+        if status != DownloadManifest.STATUS_UNCHANGED:
+            # Renaming guarantees that the contents of the final path is
+            # always complete.
+            try:
+                os.rename(tmp_filepath, filepath)
+            except:
+                os.remove(tmp_filepath)
+                raise
+        else:
+            os.remove(tmp_filepath)
+        if new_validators != validators:
+            _print_to_file(filepath + _VALIDATORS_FILENAME_SUFFIX,
+                           json.dumps(new_validators, sort_keys=True))
+        if manifest is not None:
+            manifest.record(url, os.path.relpath(filepath, download_dir),
+                            new_validators["sha1"], status)
+    return filepath
+
+def _download_meeting_document(meeting_document_url, min_interval=1, force=False,
+                               download_dir=os.path.curdir, manifest=None,
+                               retry_queue=None):
+    """Return a tuple (meeting_document_dir, is_complete)
+
+    meeting_document_dir is None if the index page could not be
+    downloaded. is_complete is True only if all pages of the document
+    were downloaded, failed pages are queued to `retry_queue`.
+
+    """
+
+    index_filepath = _download_page(meeting_document_url,
+                                    encoding="iso-8859-1",
+                                    force=True, # Refresh indices always.
+                                    min_interval=min_interval,
+                                    download_dir=download_dir,
+                                    error_policy="log",
+                                    manifest=manifest)
+    if index_filepath is None:
+        if retry_queue is not None:
+            # Retry the whole document, because the agenda items are
+            # not known without the index.
+            retry_queue.put(_retry_meeting_document, meeting_document_url,
+                            min_interval=min_interval, force=force,
+                            download_dir=download_dir, manifest=manifest)
+        return None, False
+
+    index_soup = _make_soup(index_filepath)
 
     meeting_document_dir = os.path.dirname(index_filepath)
     _print_to_file(os.path.join(meeting_document_dir, "origin_url"), meeting_document_url)
 
     cover_page_url = urljoin(meeting_document_url, _COVER_PAGE_FILENAME)
-    _download_page(cover_page_url,
+    cover_page_filepath = _download_page(cover_page_url,
                    encoding="windows-1252",
                    force=True,
                    min_interval=min_interval,
                    download_dir=download_dir,
-                   error_policy="log")
+                   error_policy="log",
+                   manifest=manifest,
+                   retry_queue=retry_queue)
+    is_complete = cover_page_filepath is not None
 
     for tr in index_soup("table")[0]("tr"):
         try:
@@ -185,14 +952,33 @@ def download_meeting_document(meeting_document_url, min_interval=1, force=False,
             continue
         agenda_item_url = urljoin(meeting_document_url,
                                   "htmtxt%d.htm" % agenda_item_number)
-        _download_page(agenda_item_url, encoding="windows-1252", force=force,
-                       min_interval=min_interval,
-                       download_dir=download_dir, error_policy="log")
-
+        agenda_item_filepath = _download_page(agenda_item_url,
+                                              encoding="windows-1252",
+                                              force=force,
+                                              min_interval=min_interval,
+                                              download_dir=download_dir,
+                                              error_policy="log",
+                                              manifest=manifest,
+                                              retry_queue=retry_queue)
+        is_complete = is_complete and agenda_item_filepath is not None
+
+    return meeting_document_dir, is_complete
+
+def _retry_meeting_document(meeting_document_url, **kwargs):
+    _, is_complete = _download_meeting_document(meeting_document_url, **kwargs)
+    return is_complete
+
+def download_meeting_document(meeting_document_url, min_interval=1, force=False,
+                              download_dir=os.path.curdir, manifest=None,
+                              retry_queue=None):
+    meeting_document_dir, _ = _download_meeting_document(
+        meeting_document_url, min_interval=min_interval, force=force,
+        download_dir=download_dir, manifest=manifest, retry_queue=retry_queue)
     return meeting_document_dir
 
-def query_meeting_document_urls(url):
-    clean_soup = _download_clean_soup(url, encoding="windows-1252")
+def query_meeting_document_urls(url, min_interval=1):
+    clean_soup = _download_clean_soup(url, encoding="windows-1252",
+                                      min_interval=min_interval)
 
     retval = []
     for h3 in clean_soup("h3"):
@@ -203,14 +989,57 @@ def query_meeting_document_urls(url):
 
     return retval
 
-def download_policymaker(policymaker_url, min_interval=1, force=False, download_dir=os.path.curdir):
-    meeting_document_urls = query_meeting_document_urls(policymaker_url)
-    for meeting_document_url in meeting_document_urls:
-        meeting_document_dir = download_meeting_document(meeting_document_url,
-                                                         min_interval=min_interval,
-                                                         force=force,
-                                                         download_dir=download_dir)
-        yield meeting_document_dir
+def download_policymaker(policymaker_url, min_interval=1, force=False,
+                         download_dir=os.path.curdir, concurrency=1,
+                         manifest=None, crawl_state=None, retry_queue=None):
+    if crawl_state is not None and crawl_state.is_done(
+        CrawlState.KIND_POLICYMAKER, policymaker_url):
+        return
+
+    meeting_document_urls = query_meeting_document_urls(policymaker_url,
+                                                        min_interval=min_interval)
+
+    if crawl_state is not None:
+        meeting_document_urls = [url for url in meeting_document_urls
+                                 if not crawl_state.is_done(
+                CrawlState.KIND_MEETING_DOCUMENT, url)]
+
+    def download(meeting_document_url):
+        meeting_document_dir, is_complete = _download_meeting_document(
+            meeting_document_url, min_interval=min_interval, force=force,
+            download_dir=download_dir, manifest=manifest,
+            retry_queue=retry_queue)
+        # A document with failed pages is downloaded again by a resumed
+        # crawl, even if the pages succeed when they are retried.
+        if crawl_state is not None and is_complete:
+            crawl_state.mark_done(CrawlState.KIND_MEETING_DOCUMENT,
+                                  meeting_document_url)
+        return meeting_document_dir, is_complete
+
+    is_complete = True
+
+    if concurrency <= 1:
+        for meeting_document_url in meeting_document_urls:
+            meeting_document_dir, is_document_complete = download(meeting_document_url)
+            is_complete = is_complete and is_document_complete
+            yield meeting_document_dir
+    else:
+        # Meeting documents are downloaded concurrently, but the shared
+        # rate limiter still keeps the requests to each host at least
+        # min_interval seconds apart. Results are yielded in the same
+        # order as in the sequential mode.
+        pool = ThreadPool(concurrency)
+        try:
+            for meeting_document_dir, is_document_complete in pool.imap(
+                download, meeting_document_urls):
+                is_complete = is_complete and is_document_complete
+                yield meeting_document_dir
+        finally:
+            pool.terminate()
+            pool.join()
+
+    if crawl_state is not None and is_complete:
+        crawl_state.mark_done(CrawlState.KIND_POLICYMAKER, policymaker_url)
 
 _RE_PERSON = re.compile(ur"([A-ZÖÄÅ][a-zöäå]*(?:-[A-ZÖÄÅ][a-zöäå]*)*(?: [A-ZÖÄÅ][a-zöäå]*(?:-[A-ZÖÄÅ][a-zöäå]*)*)+)")
 _RE_DNRO = re.compile(r"Dnro (\d+[\s\xa0\xad]?/\d+)")
@@ -220,16 +1049,55 @@ _RE_RESOLUTION = re.compile(ur"^[\s\xa0\xad]*Päätös[\s\xa0\xad]+(.*)", re.DOT
 def _trimws(text):
     return _RE_WS.sub(" ", text).strip()
 
-def _parse_agenda_item_resolution(agenda_item_soup):
-    resolutions = [(None, None)]
-
+def _parse_agenda_item_paragraphs(agenda_item_soup, number):
+    subject = None
+    number_found = False
+    dnro = None
+    dnro_found = False
+    preparers = None
+    introducers = None
+    resolution = (None, None)
     proposal = None
 
+    # All fields are recognized during a single walk over the
+    # paragraphs, and the text of each paragraph is extracted and
+    # normalized only once.
     for p in agenda_item_soup.html.body("p"):
-        resolution_match = _RE_RESOLUTION.match(p.text)
+        raw_text = p.text
+        text = _trimws(raw_text)
+
+        if subject is None:
+            if not number_found:
+                match = re.match(r"%d$|%d " % (number, number), text)
+                if match:
+                    # The paragraph starts with the given agenda item
+                    # number, the subject is nearby.
+                    number_found = True
+
+                    # In most cases, the subject follows the number
+                    # within the same paragraph.
+                    subject = text[match.end():].strip() or None
+            else:
+                # In some rare cases, the subject is the next
+                # non-whitespace paragraph.
+                subject = text.strip() or None
+
+        if not dnro_found:
+            dnro_match = _RE_DNRO.match(text)
+            if dnro_match:
+                dnro_found = True
+                dnro = dnro_match.group(1)
+
+        if preparers is None and text.startswith("Asian valmisteli"):
+            preparers = _RE_PERSON.findall(text)
+
+        if introducers is None and text.startswith("Asian esitteli"):
+            introducers = _RE_PERSON.findall(text)
+
+        resolution_match = _RE_RESOLUTION.match(raw_text)
         if resolution_match:
-            resolution = "<p>%s</p>" % _trimws(resolution_match.group(1))
-            resolutions.append((proposal, resolution))
+            resolution = (proposal,
+                          "<p>%s</p>" % _trimws(resolution_match.group(1)))
             proposal = None
             continue
 
@@ -239,75 +1107,28 @@ def _parse_agenda_item_resolution(agenda_item_soup):
             continue
 
         if proposal is not None:
-            text = _trimws(p.text)
             if text:
                 proposal += "<p>%s</p>" % text
 
-    # Consider only the last decision. The document can contain multiple
-    # proposals if the same issue has been discussed in multiple
-    # meetings. The latest is always the last.
-    return resolutions[-1]
-
-def _parse_agenda_item_preparers(agenda_item_soup):
-    preparers = []
-    for text in [_trimws(p.text) for p in agenda_item_soup("p")]:
-        if text.startswith("Asian valmisteli"):
-            preparers.extend(_RE_PERSON.findall(text))
-            break
-    return preparers
-
-def _parse_agenda_item_introducers(agenda_item_soup):
-    introducers = []
-    for text in [_trimws(p.text) for p in agenda_item_soup("p")]:
-        if text.startswith("Asian esitteli"):
-            introducers.extend(_RE_PERSON.findall(text))
-            break
-    return introducers
-
-def _parse_agenda_item_dnro(agenda_item_soup):
-    ps = agenda_item_soup.html.body("p")
-    dnros = []
-    for text in [_trimws(p.text) for p in ps]:
-        dnro_match = _RE_DNRO.match(text)
-        if dnro_match:
-            dnros.append(dnro_match.group(1))
-
-    try:
-        dnro = dnros[0]
-    except IndexError:
-        # Some of the agenda items in each meeting are "standard"
-        # agenda items, e.g. opening of the meeting, determination
-        # of quorum, which do not have Dnro.
-        dnro = None
-
+    # Some of the agenda items in each meeting are "standard" agenda
+    # items, e.g. opening of the meeting, determination of quorum, which
+    # do not have Dnro.
     if dnro == "0/00":
         dnro = None
 
-    return dnro
+    # Consider only the last decision. The document can contain multiple
+    # proposals if the same issue has been discussed in multiple
+    # meetings. The latest is always the last.
+    proposal, resolution = resolution
 
-def _parse_agenda_item_subject(agenda_item_soup, number):
-    number_found = False
-    for p in agenda_item_soup.html.body("p"):
-        text = _trimws(p.text)
-        if not number_found:
-            match = re.match(r"%d$|%d " % (number, number), text)
-            if match:
-                # The paragraph starts with the given agenda item
-                # number, the subject is nearby.
-                number_found = True
-
-                # In most cases, the subject follows the number within
-                # the same paragraph.
-                subject_candidate = text[match.end():].strip()
-                if subject_candidate:
-                    return subject_candidate
-        else:
-            # In some rare cases, the subject is the next non-whitespace
-            # paragraph.
-            subject_candidate = text.strip()
-            if subject_candidate:
-                return subject_candidate
-    return None
+    return {
+        "dnro": dnro,
+        "preparers": preparers or [],
+        "introducers": introducers or [],
+        "subject": subject,
+        "resolution": resolution,
+        "proposal": proposal,
+        }
 
 def _parse_agenda_item(agenda_item_filepath):
     agenda_item_soup = _make_soup(agenda_item_filepath)
@@ -315,21 +1136,10 @@ def _parse_agenda_item(agenda_item_filepath):
     agenda_item_filename = os.path.basename(agenda_item_filepath)
     number = int(re.match(r"htmtxt([0-9]+)\.htm", agenda_item_filename).group(1))
 
-    subject = _parse_agenda_item_subject(agenda_item_soup, number)
-    dnro = _parse_agenda_item_dnro(agenda_item_soup)
-    preparers = _parse_agenda_item_preparers(agenda_item_soup)
-    introducers = _parse_agenda_item_introducers(agenda_item_soup)
-    proposal, resolution = _parse_agenda_item_resolution(agenda_item_soup)
+    agenda_item = {"number": number}
+    agenda_item.update(_parse_agenda_item_paragraphs(agenda_item_soup, number))
 
-    return {
-        "number": number,
-        "dnro": dnro,
-        "preparers": preparers,
-        "introducers": introducers,
-        "subject": subject,
-        "resolution": resolution,
-        "proposal": proposal,
-        }
+    return agenda_item
 
 def _parse_agenda_items(meeting_document_dirpath):
     retval = []
@@ -429,7 +1239,103 @@ def _parse_meeting_document_type(meeting_document_dirpath):
 def parse_meeting_document_origin_id(meeting_document_dirpath):
     return "/".join(meeting_document_dirpath.split(os.path.sep)[-3:])
 
-def parse_meeting_document(meeting_document_dirpath):
+# Version of the output of parse_meeting_document(). It must be bumped
+# whenever the output changes for the same input, to invalidate cached
+# parse results.
+PARSER_VERSION = 1
+
+def _list_meeting_document_source_filenames(meeting_document_dirpath):
+    filenames = ["index.htm", "origin_url"]
+    agenda_item_filepath_pattern = os.path.join(meeting_document_dirpath, "htmtxt*.htm")
+    for agenda_item_filepath in glob.iglob(agenda_item_filepath_pattern):
+        filenames.append(os.path.basename(agenda_item_filepath))
+    return sorted(filenames)
+
+def compute_meeting_document_fingerprint(meeting_document_dirpath):
+    """Return SHA-1 hex digest of the source files of a meeting document
+
+    The fingerprint changes whenever any of the files the meeting
+    document is parsed from changes, appears or disappears.
+
+    """
+
+    fingerprint = hashlib.sha1()
+    for filename in _list_meeting_document_source_filenames(meeting_document_dirpath):
+        filepath = os.path.join(meeting_document_dirpath, filename)
+        try:
+            with open(filepath, "rb") as f:
+                file_sha1 = hashlib.sha1(f.read()).hexdigest()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise e
+            continue
+        fingerprint.update("%s\0%s\0" % (filename, file_sha1))
+    return fingerprint.hexdigest()
+
+def _get_meeting_document_cache_filepath(meeting_document_dirpath, cache_dir):
+    # Parse results depend on the directory path too.
+    policymaker_dirpath = os.path.join(meeting_document_dirpath, "..", "..")
+    policymaker_abbreviation = os.path.basename(os.path.abspath(policymaker_dirpath))
+    origin_id = parse_meeting_document_origin_id(meeting_document_dirpath)
+
+    # Each document has a single cache entry, hence a new parse result
+    # replaces the stale one.
+    key = hashlib.sha1("\0".join([policymaker_abbreviation,
+                                  origin_id])).hexdigest()
+
+    return os.path.join(cache_dir, key[:2], "%s.pickle" % key)
+
+def parse_meeting_document(meeting_document_dirpath, cache_dir=None,
+                           fingerprint=None):
+    """Return the meeting document in the directory as a dict
+
+    If `cache_dir` is given, the parse result of each document is
+    cached there with the contents of the source files, the parser
+    backend and PARSER_VERSION, hence an unchanged document is parsed
+    only once. A cache entry is replaced whenever the document is
+    parsed again. Cache entries are looked up by `fingerprint` if it is
+    given, see compute_meeting_document_fingerprint().
+
+    """
+
+    if cache_dir is None:
+        return _parse_meeting_document(meeting_document_dirpath)
+
+    cache_filepath = _get_meeting_document_cache_filepath(meeting_document_dirpath,
+                                                          cache_dir)
+    if fingerprint is None:
+        fingerprint = compute_meeting_document_fingerprint(meeting_document_dirpath)
+    cache_key = (PARSER_VERSION, _parser_backend, fingerprint)
+    try:
+        with open(cache_filepath, "rb") as cache_file:
+            cached_key, cached_meeting_document = pickle.load(cache_file)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise e
+    except (EOFError, ValueError, TypeError, pickle.UnpicklingError):
+        # Corrupted cache entry, just parse again.
+        pass
+    else:
+        if cached_key == cache_key:
+            return cached_meeting_document
+
+    meeting_document = _parse_meeting_document(meeting_document_dirpath)
+
+    tmp_file = _make_tmp_file(cache_filepath)
+    try:
+        pickle.dump((cache_key, meeting_document), tmp_file, pickle.HIGHEST_PROTOCOL)
+        tmp_file.close()
+        os.rename(tmp_file.name, cache_filepath)
+    except:
+        try:
+            tmp_file.close()
+        finally:
+            os.remove(tmp_file.name)
+        raise
+
+    return meeting_document
+
+def _parse_meeting_document(meeting_document_dirpath):
     meeting_document_type = _parse_meeting_document_type(meeting_document_dirpath)
 
     origin_url_filepath = os.path.join(meeting_document_dirpath, "origin_url")
@@ -457,3 +1363,56 @@ def parse_meeting_document(meeting_document_dirpath):
     meeting_document["agenda_items"] = _parse_agenda_items(meeting_document_dirpath)
 
     return meeting_document
+
+def _parse_meeting_document_safely(meeting_document_dirpath, fingerprint=None,
+                                   cache_dir=None):
+    try:
+        if fingerprint is None:
+            fingerprint = compute_meeting_document_fingerprint(meeting_document_dirpath)
+        meeting_document = parse_meeting_document(meeting_document_dirpath,
+                                                  cache_dir=cache_dir,
+                                                  fingerprint=fingerprint)
+    except Exception:
+        return (meeting_document_dirpath, fingerprint, None,
+                traceback.format_exc())
+    return meeting_document_dirpath, fingerprint, meeting_document, None
+
+def parse_meeting_documents(meeting_document_dirs, jobs=1, cache_dir=None):
+    """Return a generator of tuples (dirpath, fingerprint,
+    meeting_document, error)
+
+    `meeting_document_dirs` is an iterable of (dirpath, fingerprint)
+    tuples, where fingerprint is None if it has not been computed
+    yet. Meeting documents are parsed in `jobs` worker processes in
+    parallel and yielded in the order of `meeting_document_dirs`. If
+    parsing a meeting document fails, meeting_document is None and
+    error is a formatted traceback string, otherwise error is None. See
+    parse_meeting_document() for `cache_dir`.
+
+    """
+
+    if jobs <= 1:
+        for meeting_document_dirpath, fingerprint in meeting_document_dirs:
+            yield _parse_meeting_document_safely(meeting_document_dirpath,
+                                                 fingerprint=fingerprint,
+                                                 cache_dir=cache_dir)
+        return
+
+    pool = multiprocessing.Pool(jobs, initializer=set_parser_backend,
+                                initargs=(_parser_backend,))
+    try:
+        # Keep only a bounded number of parse results in flight, the
+        # consumer (typically a database writer) can be slower than the
+        # workers.
+        pending_results = collections.deque()
+        for meeting_document_dirpath, fingerprint in meeting_document_dirs:
+            pending_results.append(pool.apply_async(
+                    _parse_meeting_document_safely, (meeting_document_dirpath,
+                                                     fingerprint, cache_dir)))
+            if len(pending_results) >= 2 * jobs:
+                yield pending_results.popleft().get()
+        while pending_results:
+            yield pending_results.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
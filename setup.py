@@ -20,6 +20,7 @@ setup(name='klupung',
         "bin/klupung-dbimport-ktweb-geometries",
         "bin/klupung-dbimport-policymakers",
         "bin/klupung-dbinit",
+        "bin/klupung-dbupgrade",
         "bin/klupung-download-ktweb",
         "bin/klupung-stupid-apiserver",
         "bin/klupung-geocode-ktweb",
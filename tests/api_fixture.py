@@ -0,0 +1,126 @@
+# KlupuNG
+# Copyright (C) 2014 Koodilehto Osk <http://koodilehto.fi>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""API test database populated from the meeting document corpus
+
+The minutes in data/ktweb_documents are imported with
+klupung-dbimport-ktweb into a temporary SQLite database, and every
+agenda item gets a point geometry.
+
+"""
+
+import imp
+import json
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+import sqlalchemy
+
+import klupung.flask
+import klupung.flask.models
+import klupung.flask.spatial
+import klupung.ktweb
+
+from tests import DATA_DIR
+
+BIN_DIR = os.path.join(os.path.dirname(__file__), "..", "bin")
+CORPUS_DIR = os.path.join(DATA_DIR, "ktweb_documents")
+
+def load_script(name):
+    """Return the script in bin/ as a module."""
+
+    dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = True
+    try:
+        return imp.load_source(name.replace("-", "_"),
+                               os.path.join(BIN_DIR, name))
+    finally:
+        sys.dont_write_bytecode = dont_write_bytecode
+
+class APITestCase(unittest.TestCase):
+
+    config = {
+        "KLUPUNG_RESPONSE_CACHE_THRESHOLD": 0,
+        "KLUPUNG_COUNT_CACHE_TIMEOUT": 0,
+        }
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.db_uri = "sqlite:///%s" % os.path.join(self.tmp_dir, "klupung.sqlite3")
+        self.app = klupung.flask.create_app(self.db_uri, self.config)
+        # SQLAlchemy cannot remove engine listeners, the engine goes
+        # away with the application instead.
+        self.statement_count = 0
+        sqlalchemy.event.listen(klupung.flask.db.get_engine(self.app),
+                                "before_cursor_execute",
+                                self._count_statement)
+        with self.app.test_request_context():
+            self.populate_db()
+        self.client = self.app.test_client()
+
+    def _count_statement(self, *args):
+        self.statement_count += 1
+
+    def populate_db(self):
+        klupung.flask.db.create_all(app=self.app)
+
+        session = klupung.flask.db.session
+        for abbreviation, name in ((u"kh", u"Kaupunginhallitus"),
+                                   (u"ymp", u"Ymp\xe4rist\xf6lautakunta")):
+            session.add(klupung.flask.models.Policymaker(abbreviation, name, u""))
+        session.add(klupung.flask.models.Category(u"Muut", u"00"))
+        session.flush()
+        klupung.flask.models.Category.update_ancestry()
+        session.commit()
+
+        dbimport = load_script("klupung-dbimport-ktweb")
+        paatokset_dir = os.path.join(CORPUS_DIR, "paatokset")
+        batch = []
+        for dirpath, fingerprint, meeting_document_data, error in klupung.ktweb.parse_meeting_documents(
+            (dirpath, None)
+            for dirpath in sorted(dbimport.walk_meeting_document_dirs(paatokset_dir))):
+            self.assertIsNone(error, error)
+            if meeting_document_data["type"] == "minutes":
+                batch.append((meeting_document_data, fingerprint))
+        dbimport.import_batch(batch, dbimport.IdentityMap())
+
+        for i, agenda_item in enumerate(klupung.flask.models.AgendaItem.query):
+            session.add(klupung.flask.models.AgendaItemGeometry(
+                    agenda_item,
+                    klupung.flask.models.AgendaItemGeometry.CATEGORY_ADDRESS,
+                    klupung.flask.models.AgendaItemGeometry.TYPE_POINT,
+                    u"Kauppakatu %d" % (i + 1),
+                    [25.7 + i * 0.01, 62.2 + i * 0.01]))
+        session.flush()
+        klupung.flask.spatial.rebuild_index()
+        klupung.flask.models.DataVersion.bump()
+        session.commit()
+
+    def get_json(self, url, status_code=200, **kwargs):
+        response = self.client.get(url, **kwargs)
+        self.assertEqual(response.status_code, status_code, response.data)
+        return json.loads(response.data)
+
+    def count_statements(self, url):
+        """Return the number of SQL statements executed to get `url`."""
+
+        statement_count = self.statement_count
+        self.get_json(url)
+        return self.statement_count - statement_count
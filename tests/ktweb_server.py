@@ -0,0 +1,137 @@
+# KlupuNG
+# Copyright (C) 2014 Koodilehto Osk <http://koodilehto.fi>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Local stand-in for a KTweb server"""
+
+import BaseHTTPServer
+import hashlib
+import os.path
+import SocketServer
+import threading
+import time
+
+from tests import DATA_DIR
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    # Daemon threads could still be serving when the interpreter shuts
+    # down. Idle keep-alive connections time out instead.
+    daemon_threads = False
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep-alive connections are reused by the downloader.
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, do not wait for ACKs in
+    # between.
+    disable_nagle_algorithm = True
+    timeout = 5
+
+    def do_GET(self):
+        ktweb_server = self.server.ktweb_server
+        path = self.path.split("?", 1)[0]
+        ktweb_server.record_request(path, self.client_address[1])
+        time.sleep(ktweb_server.latency)
+
+        status = 200
+        body = ""
+        etag = None
+        if ktweb_server.fail(path):
+            status = 503
+        else:
+            filepath = os.path.join(ktweb_server.site_dir, *path.split("/"))
+            try:
+                with open(filepath, "rb") as f:
+                    body = f.read()
+            except IOError:
+                status = 404
+            else:
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                if self.headers.get("If-None-Match") == etag:
+                    ktweb_server.record_not_modified(path)
+                    status = 304
+                    body = ""
+
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html")
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        if ktweb_server.drop_connections:
+            # Close without telling the client, as servers do to idle
+            # keep-alive connections.
+            self.close_connection = 1
+
+    def log_message(self, format, *args):
+        pass
+
+class KTwebServer(object):
+    """HTTP server serving files of `site_dir` in a background thread
+
+    Requests are recorded as (time, path, client_port) tuples in
+    `requests`. Responses have ETags, and paths answered with 304 are
+    recorded in `not_modified_paths`. If `drop_connections` is true,
+    keep-alive connections are closed after every response. Paths in
+    `failing_paths` are answered with 503 as many times as their values
+    tell, or always if the value is None. Every response is delayed by
+    `latency` seconds.
+
+    """
+
+    def __init__(self, site_dir=os.path.join(DATA_DIR, "ktweb_site")):
+        self.site_dir = site_dir
+        self.requests = []
+        self.not_modified_paths = []
+        self.failing_paths = {}
+        self.latency = 0
+        self.drop_connections = False
+        self._lock = threading.Lock()
+        self._httpd = _ThreadingHTTPServer(("127.0.0.1", 0), _RequestHandler)
+        self._httpd.ktweb_server = self
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        kwargs={"poll_interval": 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self._httpd.server_address[1], path)
+
+    def record_request(self, path, client_port):
+        with self._lock:
+            self.requests.append((time.time(), path, client_port))
+
+    def record_not_modified(self, path):
+        with self._lock:
+            self.not_modified_paths.append(path)
+
+    def fail(self, path):
+        with self._lock:
+            if path not in self.failing_paths:
+                return False
+            failure_count = self.failing_paths[path]
+            if failure_count is not None:
+                if failure_count <= 1:
+                    del self.failing_paths[path]
+                else:
+                    self.failing_paths[path] = failure_count - 1
+            return True
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
@@ -0,0 +1,298 @@
+# KlupuNG
+# Copyright (C) 2014 Koodilehto Osk <http://koodilehto.fi>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import json
+import os.path
+
+import klupung.flask
+import klupung.flask.api
+import klupung.flask.models
+import klupung.flask.spatial
+
+from tests.api_fixture import APITestCase, load_script
+
+class StatementCountTestCase(APITestCase):
+    """Resources of a page are serialized from prefetched relationships,
+    hence the number of statements does not depend on the page size.
+
+    """
+
+    def assert_statement_count_is_constant(self, path):
+        total_count = self.get_json("%s?limit=1" % path)["meta"]["total_count"]
+        self.assertTrue(total_count > 1)
+        statement_count = self.count_statements("%s?limit=1" % path)
+        self.assertEqual(self.count_statements("%s?limit=%d" % (path, total_count)),
+                         statement_count)
+
+    def test_agenda_item(self):
+        self.assert_statement_count_is_constant("/v1/agenda_item/")
+
+    def test_issue(self):
+        self.assert_statement_count_is_constant("/v1/issue/")
+
+    def test_meeting(self):
+        self.assert_statement_count_is_constant("/v1/meeting/")
+
+    def test_meeting_document(self):
+        self.assert_statement_count_is_constant("/v1/meeting_document/")
+
+    def test_policymaker(self):
+        self.assert_statement_count_is_constant("/v1/policymaker/")
+
+class IssueSearchTestCase(APITestCase):
+
+    def search(self, query):
+        issues = self.get_json("/v1/issue/search/?%s" % query)["objects"]
+        return sorted(issue["register_id"] for issue in issues)
+
+    def test_bbox(self):
+        self.assertEqual(self.search("bbox=25.69,62.19,25.705,62.205"),
+                         [u"4/2014"])
+
+    def test_bbox_and_policymaker(self):
+        self.assertEqual(self.search("bbox=25.69,62.19,25.705,62.205&policymaker=1"),
+                         [u"4/2014"])
+        self.assertEqual(self.search("bbox=25.69,62.19,25.705,62.205&policymaker=2"),
+                         [])
+
+    def test_bbox_text_and_policymaker(self):
+        self.assertEqual(self.search("bbox=25,62,26,63&text=asemakaavan&policymaker=1"),
+                         [u"1234 /2013"])
+
+class SpatialIndexTestCase(APITestCase):
+
+    def query_index_ids(self):
+        return sorted(geometry_id for geometry_id, in klupung.flask.db.session.execute(
+                "SELECT id FROM %s" % klupung.flask.spatial.INDEX_TABLE_NAME))
+
+    def query_geometry_ids(self):
+        return sorted(geometry.id for geometry in
+                      klupung.flask.models.AgendaItemGeometry.query)
+
+    def test_deleted_agenda_items_are_unindexed(self):
+        dbimport = load_script("klupung-dbimport-ktweb")
+        with self.app.test_request_context():
+            agenda_item_ids = [agenda_item.id for agenda_item in
+                               klupung.flask.models.AgendaItem.query]
+            dbimport.delete_agenda_item_rows(agenda_item_ids[:2])
+            klupung.flask.db.session.commit()
+            self.assertEqual(len(self.query_geometry_ids()), len(agenda_item_ids) - 2)
+            self.assertEqual(self.query_index_ids(), self.query_geometry_ids())
+
+class SpatialIndexMissingTestCase(APITestCase):
+
+    def populate_db(self):
+        APITestCase.populate_db(self)
+        engine = klupung.flask.db.get_engine(self.app)
+        engine.execute("DROP TABLE %s" % klupung.flask.spatial.INDEX_TABLE_NAME)
+        # Forget that the index existed.
+        klupung.flask.spatial._index._exists_cache.pop(engine)
+
+    def test_bbox_fails(self):
+        error = self.get_json("/v1/issue/search/?bbox=25,62,26,63",
+                              status_code=500)["error"]
+        self.assertIn("klupung-dbupgrade", error)
+
+    def test_other_filters_work(self):
+        self.get_json("/v1/issue/search/?policymaker=1")
+
+class ConditionalRequestTestCase(APITestCase):
+
+    config = dict(APITestCase.config, KLUPUNG_RESPONSE_CACHE_THRESHOLD=500)
+
+    def test_not_modified(self):
+        response = self.client.get("/v1/issue/")
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["ETag"]
+        last_modified = response.headers["Last-Modified"]
+
+        # The second round is served from the response cache.
+        for _ in range(2):
+            for headers in ({"If-None-Match": etag},
+                            {"If-None-Match": "*"},
+                            {"If-Modified-Since": last_modified}):
+                response = self.client.get("/v1/issue/", headers=headers)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.headers["ETag"], etag)
+                self.assertEqual(response.data, "")
+
+    def test_modified(self):
+        response = self.client.get("/v1/issue/",
+                                   headers={"If-None-Match": '"0-stale"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_missing_resource(self):
+        response = self.client.get("/v1/issue/9999/", headers={
+                "If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn("ETag", response.headers)
+
+    def test_invalid_argument(self):
+        for _ in range(2):
+            response = self.client.get("/v1/issue/?limit=x",
+                                       headers={"If-None-Match": "*"})
+            self.assertEqual(response.status_code, 400)
+            self.assertNotIn("ETag", response.headers)
+            self.assertNotIn("Last-Modified", response.headers)
+
+class CursorPaginationTestCase(APITestCase):
+
+    def follow_cursors(self, url):
+        """Return ids of objects on all pages starting from `url`."""
+
+        ids = []
+        while url is not None:
+            resource = self.get_json(url)
+            ids.extend(obj["id"] for obj in resource["objects"])
+            url = resource["meta"]["next"]
+        return ids
+
+    def assert_cursors_list_all(self, path, order_by, query_sort_keys):
+        with self.app.test_request_context():
+            sort_keys = sorted(query_sort_keys())
+        # Ties in the sort key are broken by ids, also across pages.
+        sort_values = [sort_value for sort_value, _ in sort_keys]
+        self.assertLess(len(set(sort_values)), len(sort_values))
+        ids = [id_ for _, id_ in sort_keys]
+
+        url = "%s?limit=2&order_by=%s&after=" % (path, order_by)
+        self.assertEqual(self.follow_cursors(url), ids)
+        url = "%s?limit=2&order_by=-%s&after=" % (path, order_by)
+        self.assertEqual(self.follow_cursors(url), ids[::-1])
+
+    def test_agenda_item_by_meeting_date(self):
+        AgendaItem = klupung.flask.models.AgendaItem
+        Meeting = klupung.flask.models.Meeting
+        self.assert_cursors_list_all(
+            "/v1/agenda_item/", "meeting__date",
+            lambda: klupung.flask.db.session.query(Meeting.date, AgendaItem.id).select_from(
+                AgendaItem).join(AgendaItem.meeting).all())
+
+    def test_agenda_item_by_index(self):
+        AgendaItem = klupung.flask.models.AgendaItem
+        self.assert_cursors_list_all(
+            "/v1/agenda_item/", "index",
+            lambda: klupung.flask.db.session.query(AgendaItem.index, AgendaItem.id).all())
+
+    def test_issue_by_latest_decision_date(self):
+        Issue = klupung.flask.models.Issue
+        self.assert_cursors_list_all(
+            "/v1/issue/", "latest_decision_date",
+            lambda: klupung.flask.db.session.query(Issue.latest_decision_date,
+                                                   Issue.id).all())
+
+    def test_bad_cursor(self):
+        cursor = self.get_json("/v1/issue/?limit=1&order_by=latest_decision_date&after=")[
+            "meta"]["next_cursor"]
+        self.get_json("/v1/issue/?limit=1&order_by=latest_decision_date&after=%s" % cursor)
+
+        for bad_cursor in ("x", cursor[:-4],
+                           klupung.flask.api._encode_cursor("-latest_decision_date",
+                                                            None, 1),
+                           klupung.flask.api._encode_cursor("latest_decision_date",
+                                                            None, "1")):
+            error = self.get_json("/v1/issue/?order_by=latest_decision_date&after=%s"
+                                  % bad_cursor, status_code=400)["error"]
+            self.assertIn("after", error)
+
+class TotalCountTestCase(APITestCase):
+
+    config = dict(APITestCase.config, KLUPUNG_COUNT_CACHE_TIMEOUT=60)
+
+    def get_total_count(self, client, url="/v1/issue/"):
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200, response.data)
+        return json.loads(response.data)["meta"]["total_count"]
+
+    def add_issue(self):
+        with self.app.test_request_context():
+            category = klupung.flask.models.Category.query.first()
+            klupung.flask.db.session.add(klupung.flask.models.Issue(
+                    u"9999/2014", u"Uusi asia", u"", category,
+                    datetime.datetime(2014, 1, 1)))
+            klupung.flask.db.session.commit()
+
+    def test_total_count_false(self):
+        total_count = self.get_total_count(self.client)
+        self.assertGreater(total_count, 1)
+
+        meta = self.get_json("/v1/issue/?limit=1&total_count=false")["meta"]
+        self.assertIsNone(meta["total_count"])
+        self.assertIsNotNone(meta["next"])
+
+        meta = self.get_json("/v1/issue/?limit=%d&total_count=false" % total_count)["meta"]
+        self.assertIsNone(meta["total_count"])
+        self.assertIsNone(meta["next"])
+
+        self.get_json("/v1/issue/?total_count=x", status_code=400)
+
+    def test_version_bump_invalidates_counts(self):
+        total_count = self.get_total_count(self.client)
+
+        self.add_issue()
+        self.assertEqual(self.get_total_count(self.client), total_count)
+
+        with self.app.test_request_context():
+            klupung.flask.models.DataVersion.bump()
+            klupung.flask.db.session.commit()
+        self.assertEqual(self.get_total_count(self.client), total_count + 1)
+
+    def test_counts_are_not_shared_by_apps(self):
+        total_count = self.get_total_count(self.client)
+
+        # Another database at the same data version.
+        other_app = klupung.flask.create_app(
+            "sqlite:///%s" % os.path.join(self.tmp_dir, "other.sqlite3"), self.config)
+        with self.app.test_request_context():
+            version, _ = klupung.flask.models.DataVersion.get()
+        with other_app.test_request_context():
+            klupung.flask.db.create_all(app=other_app)
+            for _ in range(version):
+                klupung.flask.models.DataVersion.bump()
+                klupung.flask.db.session.commit()
+
+        self.assertEqual(self.get_total_count(other_app.test_client()), 0)
+        self.assertEqual(self.get_total_count(self.client), total_count)
+
+class UncachedConditionalRequestTestCase(APITestCase):
+
+    def test_not_modified_without_handling(self):
+        etag = self.client.get("/v1/issue/").headers["ETag"]
+
+        statement_count = self.statement_count
+        response = self.client.get("/v1/issue/", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["ETag"], etag)
+        # Only the data version is queried.
+        self.assertEqual(self.statement_count - statement_count, 1)
+
+    def test_etag_of_other_request(self):
+        etag = self.client.get("/v1/issue/").headers["ETag"]
+
+        response = self.client.get("/v1/issue/?limit=1",
+                                   headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get("/v1/issue/9999/",
+                                   headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 404)
+
+    def test_any_etag(self):
+        response = self.client.get("/v1/issue/9999/",
+                                   headers={"If-None-Match": "*"})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get("/v1/issue/", headers={"If-None-Match": "*"})
+        self.assertEqual(response.status_code, 304)
@@ -0,0 +1,98 @@
+# KlupuNG
+# Copyright (C) 2014 Koodilehto Osk <http://koodilehto.fi>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Response cache of the API"""
+
+import datetime
+import unittest
+
+import klupung.flask
+import klupung.flask.cache
+import klupung.flask.models
+
+from tests.api_fixture import APITestCase
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_threshold(self):
+        cache = klupung.flask.cache.LRUCache(threshold=2)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        cache.get("a")
+        cache.set("c", "3")
+
+        self.assertEqual([cache.get(key) for key in "abc"], ["1", None, "3"])
+
+    def test_max_size(self):
+        cache = klupung.flask.cache.LRUCache(threshold=10, max_size=10)
+        cache.set("a", "12345")
+        cache.set("b", "12345")
+        cache.get("a")
+        cache.set("c", "1")
+
+        self.assertEqual([cache.get(key) for key in "abc"], ["12345", None, "1"])
+
+    def test_too_large_value(self):
+        cache = klupung.flask.cache.LRUCache(threshold=10, max_size=10)
+        cache.set("a", "12345")
+        cache.set("b", "1")
+        cache.set("b", "12345678901")
+
+        self.assertEqual([cache.get(key) for key in "ab"], ["12345", None])
+
+        # The removed value does not take space anymore.
+        cache.set("c", "12345")
+        self.assertEqual([cache.get(key) for key in "ac"], ["12345", "12345"])
+
+class ResponseCacheTestCase(APITestCase):
+
+    config = dict(APITestCase.config, KLUPUNG_RESPONSE_CACHE_THRESHOLD=500)
+
+    def list_register_ids(self):
+        return [issue["register_id"] for issue in
+                self.get_json("/v1/issue/?limit=1000")["objects"]]
+
+    def test_version_bump_invalidates_responses(self):
+        register_ids = self.list_register_ids()
+
+        with self.app.test_request_context():
+            klupung.flask.db.session.add(klupung.flask.models.Issue(
+                    u"9999/2014", u"Uusi asia", u"",
+                    klupung.flask.models.Category.query.first(),
+                    datetime.datetime(2014, 1, 1)))
+            klupung.flask.db.session.commit()
+        self.assertEqual(self.list_register_ids(), register_ids)
+
+        with self.app.test_request_context():
+            klupung.flask.models.DataVersion.bump()
+            klupung.flask.db.session.commit()
+        self.assertEqual(sorted(self.list_register_ids()),
+                         sorted(register_ids + [u"9999/2014"]))
+
+class ResponseCacheSizeTestCase(APITestCase):
+
+    config = dict(APITestCase.config, KLUPUNG_RESPONSE_CACHE_THRESHOLD=500,
+                  KLUPUNG_RESPONSE_CACHE_MAX_SIZE=1500)
+
+    def test_large_responses_are_not_cached(self):
+        # A cached response is served by querying the data version only.
+        for url in ("/v1/issue/?limit=1", "/v1/issue/?limit=1000"):
+            self.get_json(url)
+        self.assertEqual(self.count_statements("/v1/issue/?limit=1"), 1)
+        self.assertGreater(self.count_statements("/v1/issue/?limit=1000"), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+# KlupuNG
+# Copyright (C) 2014 Koodilehto Osk <http://koodilehto.fi>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Synchronization of the database with a KTweb directory"""
+
+import datetime
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+
+import klupung.flask
+import klupung.flask.models
+import klupung.flask.spatial
+
+from tests.api_fixture import APITestCase, BIN_DIR, CORPUS_DIR
+
+class SyncTestCase(APITestCase):
+
+    def setUp(self):
+        APITestCase.setUp(self)
+        self.ktweb_dir = os.path.join(self.tmp_dir, "ktweb")
+        shutil.copytree(CORPUS_DIR, self.ktweb_dir)
+
+    def get_dirpath(self, origin_id):
+        return os.path.join(self.ktweb_dir, "paatokset", *origin_id.split("/"))
+
+    def sync(self, *args):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.path.join(BIN_DIR, "..")
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(BIN_DIR, "klupung-dbimport-ktweb"),
+             "--sync"] + list(args) + [self.db_uri, self.ktweb_dir],
+            env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        return process.returncode, output
+
+    def assert_sync_succeeds(self, *args):
+        returncode, output = self.sync(*args)
+        self.assertEqual(returncode, 0, output)
+
+    def query_counts(self):
+        counts = {}
+        for model in (klupung.flask.models.MeetingDocument,
+                      klupung.flask.models.Meeting,
+                      klupung.flask.models.AgendaItem,
+                      klupung.flask.models.AgendaItemGeometry,
+                      klupung.flask.models.Content,
+                      klupung.flask.models.Issue):
+            counts[model.__tablename__] = model.query.count()
+        counts["index"] = klupung.flask.db.session.execute(
+            "SELECT COUNT(*) FROM %s" % klupung.flask.spatial.INDEX_TABLE_NAME).scalar()
+        return counts
+
+    def test_unchanged(self):
+        with self.app.test_request_context():
+            counts = self.query_counts()
+        self.assert_sync_succeeds()
+        with self.app.test_request_context():
+            self.assertEqual(self.query_counts(), counts)
+
+    def assert_no_orphans(self):
+        models = klupung.flask.models
+        self.assertFalse(models.Meeting.query.filter(
+                ~models.Meeting.meeting_documents.any()).count())
+        self.assertFalse(models.AgendaItem.query.filter(
+                ~models.AgendaItem.meeting_id.in_(
+                    klupung.flask.db.session.query(models.Meeting.id))).count())
+        for model in (models.Content, models.AgendaItemGeometry):
+            self.assertFalse(model.query.filter(~model.agenda_item_id.in_(
+                        klupung.flask.db.session.query(models.AgendaItem.id))).count())
+        self.assertFalse(models.Issue.query.filter(
+                ~models.Issue.agenda_items.any()).count())
+        self.assertEqual(
+            sorted(geometry_id for geometry_id, in klupung.flask.db.session.execute(
+                    "SELECT id FROM %s" % klupung.flask.spatial.INDEX_TABLE_NAME)),
+            sorted(geometry.id for geometry in models.AgendaItemGeometry.query))
+
+    def test_removed_document(self):
+        shutil.rmtree(self.get_dirpath("kh/2014/17021600"))
+        self.assert_sync_succeeds()
+        with self.app.test_request_context():
+            self.assertEqual([meeting_document.origin_id for meeting_document in
+                              klupung.flask.models.MeetingDocument.query],
+                             [u"kh/2014/01011400"])
+            self.assertEqual([meeting.number for meeting in
+                              klupung.flask.models.Meeting.query], [1])
+            self.assert_no_orphans()
+
+    def test_moved_meeting(self):
+        filepath = os.path.join(self.get_dirpath("kh/2014/17021600"), "htmtxt0.htm")
+        with open(filepath) as f:
+            html = f.read()
+        with open(filepath, "w") as f:
+            f.write(html.replace("klo 16.00", "klo 09.00"))
+
+        self.assert_sync_succeeds()
+        with self.app.test_request_context():
+            counts = self.query_counts()
+            meeting_document = klupung.flask.models.MeetingDocument.query.filter_by(
+                origin_id=u"kh/2014/17021600").one()
+            self.assertEqual(meeting_document.meeting.date,
+                             datetime.datetime(2014, 2, 17, 9, 0))
+            self.assertEqual([(meeting.date.day, meeting.number) for meeting in
+                              klupung.flask.models.Meeting.query.order_by(
+                        klupung.flask.models.Meeting.date)],
+                             [(1, 1), (17, 1 + 1)])
+            for issue in klupung.flask.models.Issue.query:
+                self.assertEqual(issue.latest_decision_date,
+                                 max(agenda_item.meeting.date
+                                     for agenda_item in issue.agenda_items))
+            self.assert_no_orphans()
+
+        # The new meeting is not an orphan.
+        self.assert_sync_succeeds()
+        with self.app.test_request_context():
+            self.assertEqual(self.query_counts(), counts)
+
+    def test_refuse_to_delete_all(self):
+        with self.app.test_request_context():
+            counts = self.query_counts()
+        shutil.rmtree(os.path.join(self.ktweb_dir, "paatokset"))
+        os.mkdir(os.path.join(self.ktweb_dir, "paatokset"))
+        returncode, output = self.sync()
+        self.assertEqual(returncode, 1, output)
+        with self.app.test_request_context():
+            self.assertEqual(self.query_counts(), counts)
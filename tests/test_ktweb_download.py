@@ -0,0 +1,470 @@
+# KlupuNG
+# Copyright (C) 2014 Koodilehto Osk <http://koodilehto.fi>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import httplib
+import os
+import os.path
+import shutil
+import socket
+import tempfile
+import unittest
+
+from urllib2 import HTTPError
+
+import klupung.ktweb
+
+from tests.ktweb_server import KTwebServer
+
+MEETING_DOCUMENT_PATHS = (
+    "/paatokset/kh/2014/01011400/",
+    "/paatokset/kh/2014/02021400/",
+    "/paatokset/kh/2013/05051400/",
+    )
+
+PAGE_FILENAMES = ("index.htm", "htmtxt0.htm", "htmtxt1.htm", "htmtxt2.htm",
+                  "htmtxt3.htm")
+
+def list_files(dirpath):
+    filepaths = set()
+    for dirpath_, _, filenames in os.walk(dirpath):
+        for filename in filenames:
+            filepaths.add(os.path.relpath(os.path.join(dirpath_, filename), dirpath))
+    return filepaths
+
+def expected_meeting_document_files(meeting_document_path):
+    dirpath = meeting_document_path.strip("/")
+    filepaths = set([os.path.join(dirpath, "origin_url")])
+    for filename in PAGE_FILENAMES:
+        filepaths.add(os.path.join(dirpath, filename))
+        filepaths.add(os.path.join(dirpath, filename + ".validators"))
+    return filepaths
+
+class KTwebDownloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = KTwebServer()
+        self.download_dir = tempfile.mkdtemp()
+        klupung.ktweb.configure_connection_pool(size=4, timeout=10)
+        klupung.ktweb.configure_retries(max_retries=0, max_host_failures=0)
+
+    def tearDown(self):
+        klupung.ktweb.configure_connection_pool()
+        klupung.ktweb.configure_retries()
+        self.server.close()
+        shutil.rmtree(self.download_dir)
+
+    def download_policymaker(self, **kwargs):
+        return list(klupung.ktweb.download_policymaker(
+                self.server.url("/kh/index.htm"),
+                download_dir=self.download_dir, **kwargs))
+
+class RecordingRateLimiter(klupung.ktweb._RateLimiter):
+    """Rate limiter which records the times of the tokens it gives.
+
+    Arrival times of requests at the server jitter with thread
+    scheduling, token times do not.
+
+    """
+
+    def __init__(self):
+        klupung.ktweb._RateLimiter.__init__(self)
+        self.token_times = []
+
+    def wait(self, url, min_interval):
+        token_time = klupung.ktweb._RateLimiter.wait(self, url, min_interval)
+        self.token_times.append(token_time)
+        return token_time
+
+class ConcurrentDownloadTestCase(KTwebDownloadTestCase):
+
+    MIN_INTERVAL = 0.05
+
+    def setUp(self):
+        KTwebDownloadTestCase.setUp(self)
+        self.rate_limiter = RecordingRateLimiter()
+        self.old_rate_limiter = klupung.ktweb._rate_limiter
+        klupung.ktweb._rate_limiter = self.rate_limiter
+
+    def tearDown(self):
+        klupung.ktweb._rate_limiter = self.old_rate_limiter
+        KTwebDownloadTestCase.tearDown(self)
+
+    def test_concurrent_download(self):
+        # Slow responses make the downloads overlap.
+        self.server.latency = 0.2
+
+        meeting_document_dirs = self.download_policymaker(
+            min_interval=self.MIN_INTERVAL, concurrency=3)
+
+        self.assertEqual(meeting_document_dirs,
+                         [os.path.normpath(self.download_dir + path)
+                          for path in MEETING_DOCUMENT_PATHS])
+
+        expected_files = set()
+        for path in MEETING_DOCUMENT_PATHS:
+            expected_files |= expected_meeting_document_files(path)
+        self.assertEqual(list_files(self.download_dir), expected_files)
+
+        # Every request took a token.
+        request_count = 1 + len(MEETING_DOCUMENT_PATHS) * len(PAGE_FILENAMES)
+        self.assertEqual(len(self.server.requests), request_count)
+        token_times = sorted(self.rate_limiter.token_times)
+        self.assertEqual(len(token_times), request_count)
+        min_spacing = min(t2 - t1 for t1, t2 in zip(token_times, token_times[1:]))
+        # Token times are sums of intervals, allow for rounding.
+        self.assertGreaterEqual(min_spacing, self.MIN_INTERVAL - 1e-6)
+
+        # Overlapping downloads use more than one connection.
+        client_ports = set(port for _, _, port in self.server.requests)
+        self.assertGreater(len(client_ports), 1)
+
+class ConditionalDownloadTestCase(KTwebDownloadTestCase):
+
+    MEETING_DOCUMENT_PATH = MEETING_DOCUMENT_PATHS[0]
+
+    def setUp(self):
+        KTwebDownloadTestCase.setUp(self)
+        self.download_policymaker(min_interval=0)
+        self.server.not_modified_paths = []
+
+    def get_filepath(self, filename):
+        return os.path.join(self.download_dir,
+                            self.MEETING_DOCUMENT_PATH.strip("/"), filename)
+
+    def test_not_modified(self):
+        self.download_policymaker(min_interval=0)
+
+        # Index pages are always requested again, conditionally.
+        self.assertIn(self.MEETING_DOCUMENT_PATH + "index.htm",
+                      self.server.not_modified_paths)
+        self.assertTrue(os.path.exists(self.get_filepath("index.htm")))
+
+    def test_missing_page(self):
+        os.remove(self.get_filepath("index.htm"))
+        os.remove(self.get_filepath("htmtxt1.htm"))
+
+        self.download_policymaker(min_interval=0)
+
+        for filename in ("index.htm", "htmtxt1.htm"):
+            self.assertNotIn(self.MEETING_DOCUMENT_PATH + filename,
+                             self.server.not_modified_paths)
+            self.assertTrue(os.path.exists(self.get_filepath(filename)))
+            self.assertTrue(os.path.exists(self.get_filepath(filename + ".validators")))
+
+    def test_orphan_validators_are_deleted(self):
+        os.remove(self.get_filepath("htmtxt1.htm"))
+        self.server.failing_paths[self.MEETING_DOCUMENT_PATH + "htmtxt1.htm"] = None
+
+        self.download_policymaker(min_interval=0)
+
+        self.assertFalse(os.path.exists(self.get_filepath("htmtxt1.htm.validators")))
+
+class DroppedConnectionTestCase(KTwebDownloadTestCase):
+
+    def setUp(self):
+        KTwebDownloadTestCase.setUp(self)
+        self.rate_limiter = RecordingRateLimiter()
+        self.old_rate_limiter = klupung.ktweb._rate_limiter
+        klupung.ktweb._rate_limiter = self.rate_limiter
+        self.send_count = 0
+        self.old_request = httplib.HTTPConnection.request
+        def request(connection, *args, **kwargs):
+            self.send_count += 1
+            return self.old_request(connection, *args, **kwargs)
+        httplib.HTTPConnection.request = request
+
+    def tearDown(self):
+        httplib.HTTPConnection.request = self.old_request
+        klupung.ktweb._rate_limiter = self.old_rate_limiter
+        KTwebDownloadTestCase.tearDown(self)
+
+    def test_resent_requests_take_tokens(self):
+        self.server.drop_connections = True
+
+        self.download_policymaker(min_interval=0)
+
+        # Requests over dropped connections were sent again.
+        self.assertGreater(self.send_count, len(self.server.requests))
+        self.assertEqual(len(self.rate_limiter.token_times), self.send_count)
+
+class ResumedDownloadTestCase(KTwebDownloadTestCase):
+
+    FAILING_PATH = MEETING_DOCUMENT_PATHS[1] + "htmtxt2.htm"
+
+    def setUp(self):
+        KTwebDownloadTestCase.setUp(self)
+        self.crawl_state_filepath = os.path.join(self.download_dir, "crawl.state")
+
+    def download_with_retries(self):
+        crawl_state = klupung.ktweb.CrawlState(self.crawl_state_filepath)
+        retry_queue = klupung.ktweb.RetryQueue()
+        try:
+            self.download_policymaker(min_interval=0, crawl_state=crawl_state,
+                                      retry_queue=retry_queue)
+            return retry_queue.retry()
+        finally:
+            crawl_state.close()
+
+    def test_failed_page_is_reported_by_retry(self):
+        self.server.failing_paths[self.FAILING_PATH] = None
+
+        failed_urls = self.download_with_retries()
+
+        self.assertEqual(failed_urls, [self.server.url(self.FAILING_PATH)])
+
+    def test_retried_page_is_not_reported(self):
+        self.server.failing_paths[self.FAILING_PATH] = 1
+
+        failed_urls = self.download_with_retries()
+
+        self.assertEqual(failed_urls, [])
+
+    def test_document_with_failed_page_is_not_done(self):
+        self.server.failing_paths[self.FAILING_PATH] = None
+        self.download_with_retries()
+
+        crawl_state = klupung.ktweb.CrawlState(self.crawl_state_filepath)
+        try:
+            self.assertFalse(crawl_state.is_done(
+                    klupung.ktweb.CrawlState.KIND_POLICYMAKER,
+                    self.server.url("/kh/index.htm")))
+            for path in MEETING_DOCUMENT_PATHS:
+                self.assertEqual(crawl_state.is_done(
+                        klupung.ktweb.CrawlState.KIND_MEETING_DOCUMENT,
+                        self.server.url(path + "index.htm")),
+                                 path != MEETING_DOCUMENT_PATHS[1])
+        finally:
+            crawl_state.close()
+
+        # The resumed crawl downloads only the incomplete document.
+        del self.server.failing_paths[self.FAILING_PATH]
+        del self.server.requests[:]
+        failed_urls = self.download_with_retries()
+
+        self.assertEqual(failed_urls, [])
+        requested_paths = set(path for _, path, _ in self.server.requests)
+        self.assertEqual(requested_paths,
+                         set(["/kh/index.htm", self.FAILING_PATH,
+                              MEETING_DOCUMENT_PATHS[1] + "index.htm",
+                              MEETING_DOCUMENT_PATHS[1] + "htmtxt0.htm"]))
+
+class RetryPolicyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.retry_policy = klupung.ktweb._RetryPolicy()
+
+    def test_network_errors_are_transient(self):
+        for error in (socket.error(errno.ECONNRESET, "reset"),
+                      socket.timeout("timed out"),
+                      httplib.BadStatusLine(""),
+                      HTTPError("http://localhost/", 503, "", {}, None)):
+            self.assertTrue(self.retry_policy.is_transient(error), error)
+
+    def test_local_errors_are_not_transient(self):
+        for error in (IOError(errno.ENOSPC, "No space left on device"),
+                      OSError(errno.EACCES, "Permission denied"),
+                      HTTPError("http://localhost/", 404, "", {}, None)):
+            self.assertFalse(self.retry_policy.is_transient(error), error)
+
+    def test_backoff_limits(self):
+        retry_policy = klupung.ktweb._RetryPolicy(backoff=1, max_backoff=5)
+        max_pauses = []
+        pauses = []
+        def uniform(a, b):
+            max_pauses.append(b)
+            return b
+        self.patch(klupung.ktweb.random, "uniform", uniform)
+        self.patch(klupung.ktweb.time, "sleep", pauses.append)
+
+        for retry_number in range(1, 6):
+            retry_policy.sleep(retry_number)
+
+        self.assertEqual(max_pauses, [1, 2, 4, 5, 5])
+        self.assertEqual(pauses, max_pauses)
+
+    def patch(self, obj, name, value):
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+
+class RetryTestCase(KTwebDownloadTestCase):
+
+    PATH = MEETING_DOCUMENT_PATHS[0] + "htmtxt1.htm"
+
+    def download(self):
+        return klupung.ktweb._download_page(self.server.url(self.PATH),
+                                            force=True, min_interval=0,
+                                            download_dir=self.download_dir)
+
+    def test_transient_failures_are_retried(self):
+        klupung.ktweb.configure_retries(max_retries=2, backoff=0,
+                                        max_host_failures=0)
+        self.server.failing_paths[self.PATH] = 2
+
+        self.assertTrue(os.path.isfile(self.download()))
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_retries_are_limited(self):
+        klupung.ktweb.configure_retries(max_retries=2, backoff=0,
+                                        max_host_failures=0)
+        self.server.failing_paths[self.PATH] = 3
+
+        self.assertRaises(HTTPError, self.download)
+        self.assertEqual(len(self.server.requests), 3)
+
+class CircuitBreakerTestCase(KTwebDownloadTestCase):
+
+    PATH = MEETING_DOCUMENT_PATHS[0] + "htmtxt1.htm"
+
+    def download(self, path=PATH):
+        return klupung.ktweb._download_page(self.server.url(path),
+                                            force=True, min_interval=0,
+                                            download_dir=self.download_dir)
+
+    def test_open_after_consecutive_failures(self):
+        klupung.ktweb.configure_retries(max_retries=0, max_host_failures=2,
+                                        host_reset_timeout=None)
+        self.server.failing_paths[self.PATH] = None
+
+        self.assertRaises(HTTPError, self.download)
+        self.assertRaises(HTTPError, self.download)
+        self.assertRaises(klupung.ktweb.HostUnavailableError, self.download)
+        self.assertRaises(klupung.ktweb.HostUnavailableError, self.download,
+                          MEETING_DOCUMENT_PATHS[0] + "htmtxt2.htm")
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_success_resets_failures(self):
+        klupung.ktweb.configure_retries(max_retries=0, max_host_failures=2,
+                                        host_reset_timeout=None)
+        self.server.failing_paths[self.PATH] = None
+
+        self.assertRaises(HTTPError, self.download)
+        self.download(MEETING_DOCUMENT_PATHS[0] + "htmtxt2.htm")
+        self.assertRaises(HTTPError, self.download)
+        self.assertRaises(HTTPError, self.download)
+        self.assertRaises(klupung.ktweb.HostUnavailableError, self.download)
+        self.assertEqual(len(self.server.requests), 4)
+
+    def test_open_until_reset_timeout(self):
+        klupung.ktweb.configure_retries(max_retries=0, max_host_failures=1,
+                                        host_reset_timeout=60)
+        self.server.failing_paths[self.PATH] = 1
+
+        self.assertRaises(HTTPError, self.download)
+        self.assertRaises(klupung.ktweb.HostUnavailableError, self.download)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_half_open(self):
+        klupung.ktweb.configure_retries(max_retries=0, max_host_failures=1,
+                                        host_reset_timeout=0)
+        url = self.server.url(self.PATH)
+        self.server.failing_paths[self.PATH] = 2
+
+        self.assertRaises(HTTPError, self.download)
+
+        # Only one trial request is let through at a time.
+        klupung.ktweb._circuit_breaker.check(url)
+        self.assertRaises(klupung.ktweb.HostUnavailableError,
+                          klupung.ktweb._circuit_breaker.check, url)
+
+        # A failed trial opens the circuit again...
+        klupung.ktweb._circuit_breaker.record_failure(url)
+        self.assertRaises(HTTPError, self.download)
+        self.assertEqual(len(self.server.requests), 2)
+
+        # ...and a successful one closes it.
+        self.assertTrue(os.path.isfile(self.download()))
+        self.assertTrue(os.path.isfile(self.download()))
+        self.assertEqual(len(self.server.requests), 4)
+
+class RetryQueueTestCase(KTwebDownloadTestCase):
+
+    PATH = MEETING_DOCUMENT_PATHS[0] + "htmtxt1.htm"
+
+    def setUp(self):
+        KTwebDownloadTestCase.setUp(self)
+        self.retry_queue = klupung.ktweb.RetryQueue()
+
+    def download(self):
+        return klupung.ktweb._download_page(self.server.url(self.PATH),
+                                            min_interval=0,
+                                            download_dir=self.download_dir,
+                                            error_policy="ignore",
+                                            retry_queue=self.retry_queue)
+
+    def test_replay(self):
+        self.server.failing_paths[self.PATH] = 1
+
+        self.assertIsNone(self.download())
+        self.assertEqual(len(self.retry_queue), 1)
+
+        self.assertEqual(self.retry_queue.retry(), [])
+        self.assertEqual(len(self.retry_queue), 0)
+        self.assertTrue(os.path.isfile(os.path.normpath(self.download_dir + self.PATH)))
+        self.assertEqual([path for _, path, _ in self.server.requests],
+                         [self.PATH, self.PATH])
+
+    def test_replay_to_unavailable_host(self):
+        klupung.ktweb.configure_retries(max_retries=0, max_host_failures=1,
+                                        host_reset_timeout=60)
+        self.server.failing_paths[self.PATH] = 1
+
+        self.assertIsNone(self.download())
+
+        self.assertEqual(self.retry_queue.retry(), [self.server.url(self.PATH)])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_replay_after_reset_timeout(self):
+        klupung.ktweb.configure_retries(max_retries=0, max_host_failures=1,
+                                        host_reset_timeout=0)
+        self.server.failing_paths[self.PATH] = 1
+
+        self.assertIsNone(self.download())
+
+        self.assertEqual(self.retry_queue.retry(), [])
+        self.assertEqual(len(self.server.requests), 2)
+
+class LocalErrorTestCase(KTwebDownloadTestCase):
+
+    def setUp(self):
+        KTwebDownloadTestCase.setUp(self)
+        self.make_tmp_file = klupung.ktweb._make_tmp_file
+
+    def tearDown(self):
+        klupung.ktweb._make_tmp_file = self.make_tmp_file
+        KTwebDownloadTestCase.tearDown(self)
+
+    def test_local_error_is_not_retried(self):
+        klupung.ktweb.configure_retries(max_retries=3, backoff=0,
+                                        max_host_failures=1)
+        url = self.server.url(MEETING_DOCUMENT_PATHS[0] + "htmtxt1.htm")
+
+        def make_tmp_file_on_full_disk(filepath):
+            raise IOError(errno.ENOSPC, "No space left on device")
+        klupung.ktweb._make_tmp_file = make_tmp_file_on_full_disk
+
+        self.assertRaises(IOError, klupung.ktweb._download_page, url,
+                          min_interval=0, download_dir=self.download_dir)
+        self.assertEqual(len(self.server.requests), 1)
+
+        # The host is still available.
+        klupung.ktweb._make_tmp_file = self.make_tmp_file
+        filepath = klupung.ktweb._download_page(url, min_interval=0,
+                                                download_dir=self.download_dir)
+        self.assertTrue(os.path.isfile(filepath))
+
+if __name__ == "__main__":
+    unittest.main()
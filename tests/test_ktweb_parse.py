@@ -0,0 +1,160 @@
+# KlupuNG
+# Copyright (C) 2014 Koodilehto Osk <http://koodilehto.fi>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Conformance of parse_meeting_document() across parser backends
+
+The corpus in data/ktweb_documents contains downloaded (cleaned)
+meeting documents. Every backend must parse them to the result stored
+in data/ktweb_documents.json. Run this module as a script to rewrite
+the stored result after an intentional change of the parser output.
+
+"""
+
+import json
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+import klupung.ktweb
+
+from tests import DATA_DIR
+
+CORPUS_DIR = os.path.join(DATA_DIR, "ktweb_documents")
+EXPECTED_FILEPATH = os.path.join(DATA_DIR, "ktweb_documents.json")
+
+def find_meeting_document_dirs():
+    dirpaths = []
+    for dirpath, _, _ in os.walk(CORPUS_DIR):
+        if os.path.exists(os.path.join(dirpath, "index.htm")):
+            dirpaths.append(dirpath)
+    return sorted(dirpaths)
+
+def _to_json_value(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+def parse_corpus(parser_backend):
+    """Return a dict of meeting documents in the corpus parsed with
+    `parser_backend`, in a JSON-compatible form, by origin ids.
+
+    """
+
+    old_parser_backend = klupung.ktweb.get_parser_backend()
+    klupung.ktweb.set_parser_backend(parser_backend)
+    try:
+        meeting_documents = {}
+        for dirpath in find_meeting_document_dirs():
+            meeting_document = klupung.ktweb.parse_meeting_document(dirpath)
+            meeting_document = dict((k, _to_json_value(v))
+                                    for k, v in meeting_document.items())
+            # Agenda items are listed in the order of files in the
+            # directory, which depends on the filesystem.
+            meeting_document["agenda_items"].sort(key=lambda a: a["number"])
+            meeting_documents[meeting_document["origin_id"]] = meeting_document
+        return meeting_documents
+    finally:
+        klupung.ktweb.set_parser_backend(old_parser_backend)
+
+class ParserBackendConformanceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        with open(EXPECTED_FILEPATH) as expected_file:
+            self.expected = json.load(expected_file)
+
+    def assert_backend_conforms(self, parser_backend):
+        if not klupung.ktweb._is_parser_backend_available(parser_backend):
+            self.skipTest("parser backend %r is not installed" % parser_backend)
+        self.assertEqual(parse_corpus(parser_backend), self.expected)
+
+    def test_corpus_is_not_empty(self):
+        self.assertEqual(len(self.expected), len(find_meeting_document_dirs()))
+        self.assertTrue(self.expected)
+
+    def test_lxml(self):
+        self.assert_backend_conforms(klupung.ktweb.PARSER_BACKEND_LXML)
+
+    def test_html_parser(self):
+        self.assert_backend_conforms(klupung.ktweb.PARSER_BACKEND_HTMLPARSER)
+
+    def test_html5lib(self):
+        self.assert_backend_conforms(klupung.ktweb.PARSER_BACKEND_HTML5LIB)
+
+class ParseCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, "cache")
+        self.dirpath = os.path.join(self.tmp_dir, "kh", "2014", "01011400")
+        shutil.copytree(os.path.join(CORPUS_DIR, "paatokset", "kh", "2014",
+                                     "01011400"),
+                        self.dirpath)
+        self.old_parser_version = klupung.ktweb.PARSER_VERSION
+
+    def tearDown(self):
+        klupung.ktweb.PARSER_VERSION = self.old_parser_version
+        shutil.rmtree(self.tmp_dir)
+
+    def list_cache_filepaths(self):
+        filepaths = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            filepaths.extend(os.path.join(dirpath, filename)
+                             for filename in filenames)
+        return filepaths
+
+    def parse(self):
+        return klupung.ktweb.parse_meeting_document(self.dirpath,
+                                                    cache_dir=self.cache_dir)
+
+    def test_cached_result_equals_parse_result(self):
+        expected = klupung.ktweb.parse_meeting_document(self.dirpath)
+        self.assertEqual(self.parse(), expected)
+        self.assertEqual(len(self.list_cache_filepaths()), 1)
+        self.assertEqual(self.parse(), expected)
+
+    def test_changed_document_replaces_entry(self):
+        self.parse()
+        with open(os.path.join(self.dirpath, "index.htm"), "a") as index_file:
+            index_file.write("\n")
+        self.parse()
+        klupung.ktweb.PARSER_VERSION += 1
+        self.parse()
+        self.assertEqual(len(self.list_cache_filepaths()), 1)
+
+class ParallelParseTestCase(unittest.TestCase):
+
+    def parse(self, jobs):
+        # More documents than there are parse results in flight, and a
+        # failing one in between.
+        dirpaths = find_meeting_document_dirs() * 3
+        dirpaths.insert(4, os.path.join(CORPUS_DIR, "missing"))
+        return list(klupung.ktweb.parse_meeting_documents(
+                ((dirpath, None) for dirpath in dirpaths), jobs=jobs))
+
+    def test_results_equal_serial_results(self):
+        serial_results = self.parse(jobs=1)
+        self.assertIsNotNone(serial_results[4][3])
+        self.assertEqual(self.parse(jobs=2), serial_results)
+
+if __name__ == "__main__":
+    with open(EXPECTED_FILEPATH, "w") as expected_file:
+        json.dump(parse_corpus(klupung.ktweb.PARSER_BACKEND_HTMLPARSER),
+                  expected_file, indent=1, sort_keys=True,
+                  separators=(",", ": "))
+        expected_file.write("\n")
@@ -0,0 +1,151 @@
+# KlupuNG
+# Copyright (C) 2014 Koodilehto Osk <http://koodilehto.fi>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Materialized columns of the models"""
+
+import datetime
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import klupung.flask
+
+from klupung.flask.models import Category, Meeting, Policymaker
+
+class ModelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.app = klupung.flask.create_app(
+            "sqlite:///%s" % os.path.join(tmp_dir, "klupung.sqlite3"))
+        context = self.app.test_request_context()
+        context.push()
+        self.addCleanup(context.pop)
+        klupung.flask.db.create_all(app=self.app)
+        self.session = klupung.flask.db.session
+
+class MeetingNumberTestCase(ModelTestCase):
+
+    def setUp(self):
+        ModelTestCase.setUp(self)
+        self.kh = Policymaker(u"kh", u"Kaupunginhallitus", u"")
+        self.ymp = Policymaker(u"ymp", u"Ymp\xe4rist\xf6lautakunta", u"")
+        self.session.add_all([self.kh, self.ymp])
+        self.add_meetings(self.kh, [(2014, 3, 1), (2014, 1, 1), (2013, 12, 31)])
+        self.add_meetings(self.ymp, [(2014, 2, 1)])
+        self.session.flush()
+        for policymaker in (self.kh, self.ymp):
+            for year in (2013, 2014):
+                Meeting.renumber(policymaker.id, year)
+
+    def add_meetings(self, policymaker, dates):
+        meetings = [Meeting(datetime.datetime(*date), policymaker)
+                    for date in dates]
+        self.session.add_all(meetings)
+        return meetings
+
+    def query_numbers(self, policymaker):
+        return [(date.date().isoformat(), number) for date, number in
+                self.session.query(Meeting.date, Meeting.number).filter(
+                Meeting.policymaker_id == policymaker.id).order_by(Meeting.date)]
+
+    def test_numbers(self):
+        self.assertEqual(self.query_numbers(self.kh),
+                         [("2013-12-31", 1), ("2014-01-01", 1), ("2014-03-01", 2)])
+        self.assertEqual(self.query_numbers(self.ymp), [("2014-02-01", 1)])
+
+    def test_insert(self):
+        self.add_meetings(self.kh, [(2014, 2, 1), (2014, 4, 1)])
+        self.session.flush()
+        Meeting.renumber(self.kh.id, 2014)
+
+        self.assertEqual(self.query_numbers(self.kh),
+                         [("2013-12-31", 1), ("2014-01-01", 1), ("2014-02-01", 2),
+                          ("2014-03-01", 3), ("2014-04-01", 4)])
+        self.assertEqual(self.query_numbers(self.ymp), [("2014-02-01", 1)])
+
+    def test_delete(self):
+        self.session.delete(Meeting.query.filter_by(
+                policymaker_id=self.kh.id, date=datetime.datetime(2014, 1, 1)).one())
+        self.session.flush()
+        Meeting.renumber(self.kh.id, 2014)
+
+        self.assertEqual(self.query_numbers(self.kh),
+                         [("2013-12-31", 1), ("2014-03-01", 1)])
+
+    def test_renumber_empty_year(self):
+        Meeting.renumber(self.kh.id, 2015)
+
+        self.assertEqual(self.query_numbers(self.kh),
+                         [("2013-12-31", 1), ("2014-01-01", 1), ("2014-03-01", 2)])
+
+class CategoryAncestryTestCase(ModelTestCase):
+
+    def setUp(self):
+        ModelTestCase.setUp(self)
+        self.a = Category(u"A", u"01")
+        self.b = Category(u"B", u"02")
+        self.a1 = Category(u"A1", u"01 01", parent=self.a)
+        self.a11 = Category(u"A11", u"01 01 01", parent=self.a1)
+        self.session.add_all([self.a, self.b, self.a1, self.a11])
+        Category.update_ancestry()
+        self.session.commit()
+
+    def query_ancestry(self):
+        categories_by_id = dict((c.id, c.origin_id) for c in Category.query)
+        return dict((origin_id, (level, categories_by_id[top_category_id]))
+                    for origin_id, level, top_category_id in self.session.query(
+                Category.origin_id, Category.level, Category.top_category_id))
+
+    def test_ancestry(self):
+        self.assertEqual(self.query_ancestry(), {
+                u"01": (0, u"01"),
+                u"02": (0, u"02"),
+                u"01 01": (1, u"01"),
+                u"01 01 01": (2, u"01"),
+                })
+
+    def test_reparent(self):
+        self.a1.parent = self.b
+        Category.update_ancestry()
+        self.session.commit()
+
+        self.assertEqual(self.query_ancestry(), {
+                u"01": (0, u"01"),
+                u"02": (0, u"02"),
+                u"01 01": (1, u"02"),
+                u"01 01 01": (2, u"02"),
+                })
+        self.assertEqual(self.a11.top_category, self.b)
+        self.assertEqual(self.a11.find_top_category(), self.b)
+
+    def test_reparent_to_top_level(self):
+        self.a1.parent = None
+        Category.update_ancestry()
+        self.session.commit()
+
+        self.assertEqual(self.query_ancestry(), {
+                u"01": (0, u"01"),
+                u"02": (0, u"02"),
+                u"01 01": (0, u"01 01"),
+                u"01 01 01": (1, u"01 01"),
+                })
+        self.assertEqual(self.a11.find_top_category(), self.a1)
+
+if __name__ == "__main__":
+    unittest.main()